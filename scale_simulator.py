@@ -0,0 +1,219 @@
+"""Load test for peer discovery and text messaging with many peers on one host.
+
+Every virtual peer is a real Peer bound to its own loopback alias
+(127.0.0.2, 127.0.0.3, ...), so discovery, sessions and the outbox run
+unchanged. Linux routes all of 127.0.0.0/8 to loopback; on macOS the aliases
+have to be added first (ifconfig lo0 alias 127.0.0.N up).
+
+Example: python scale_simulator.py --peers 300 --processes 3
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from working_backend import Peer, BROADCAST_INTERVAL
+
+try:
+    import resource  # Unix only, used for the file limit and memory figures
+except ImportError:
+    resource = None
+
+# Away from the default ports so a real peer on this host can keep running
+SIM_BROADCAST_PORT = 15001
+SIM_SESSION_PORT = 15011
+FIRST_ADDRESS = 2  # 127.0.0.1 is left alone
+POLL_INTERVAL = 0.05
+STARTUP_DELAY = 1.0  # Seconds for worker processes to create their peers, plus PEER_STARTUP_DELAY each
+PEER_STARTUP_DELAY = 0.005
+
+
+def peer_address(index):
+    """Loopback alias of virtual peer index, counting up from 127.0.0.2."""
+    number = index + FIRST_ADDRESS
+    return f"127.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}"
+
+
+def message_targets(sender, total, messages, fanout, seed):
+    """The recipients of each scripted message from sender, the same in every process."""
+    rng = random.Random(seed * 1000003 + sender)
+    others = [index for index in range(total) if index != sender]
+    targets = rng.sample(others, min(fanout, len(others)))
+    return [targets[n % len(targets)] for n in range(messages)] if targets else []
+
+
+class SimulatedPeer(Peer):
+    """Peer that records the latency of each scripted message it receives."""
+
+    def __init__(self, index, addresses, data_dir, broadcast_interval):
+        super().__init__(username=f"sim-{index}", bind_address=addresses[index],
+                         broadcast_port=SIM_BROADCAST_PORT, session_port=SIM_SESSION_PORT,
+                         broadcast_addresses=addresses, broadcast_interval=broadcast_interval,
+                         data_dir=data_dir, with_audio=False)
+        self.index = index
+        self.converged_at = None
+        self.latencies = {}  # Message key -> seconds from send to delivery
+        # Every chat window is open, so messages go straight to the callback
+        self.active_windows.update(addresses)
+        self.set_text_message_callback(self._record_message)
+
+    def start(self):
+        for target in (self.broadcast_presence, self.listen_for_peers, self.listen_for_sessions):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _record_message(self, message, addr):
+        _, key, sent_at = message.split()
+        self.latencies.setdefault(key, time.time() - float(sent_at))
+
+    def save_file(self, sender, message):
+        """Chat history is not part of the measurement."""
+
+
+def _raise_file_limit():
+    """Lifts the open file limit to the hard maximum, every peer needs a few sockets."""
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _peak_memory_kib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+
+
+def run_peers(indices, total, messages=20, fanout=3, rate=2.0, broadcast_interval=BROADCAST_INTERVAL,
+              discovery_timeout=30.0, drain_timeout=30.0, seed=1, start_at=None):
+    """Runs the virtual peers in indices inside this process and returns their measurements.
+
+    All processes start announcing at start_at. Each peer then sends its
+    scripted messages, `rate` per second, and the run ends when every message
+    addressed to these peers has arrived or drain_timeout has passed.
+    """
+    _raise_file_limit()
+    addresses = tuple(peer_address(index) for index in range(total))
+    data_root = tempfile.mkdtemp(prefix="p2p_sim_")
+    memory_before = _peak_memory_kib()
+    cpu_before = time.process_time()
+    peers = []
+    try:
+        for index in indices:
+            peers.append(SimulatedPeer(index, addresses, os.path.join(data_root, str(index)), broadcast_interval))
+        if start_at is not None:
+            time.sleep(max(0.0, start_at - time.time()))
+        started = time.time()
+        for peer in peers:
+            peer.start()
+
+        # Discovery: a peer has converged once it has heard from every other peer
+        deadline = started + discovery_timeout
+        while time.time() < deadline:
+            now = time.time()
+            for peer in peers:
+                if peer.converged_at is None and len(peer.peers) >= total - 1:
+                    peer.converged_at = now - started
+            if all(peer.converged_at is not None for peer in peers):
+                break
+            time.sleep(POLL_INTERVAL)
+
+        # Scripted traffic, plus what the other processes will send to these peers
+        local = {peer.index: peer for peer in peers}
+        expected = 0
+        schedules = {}
+        for sender in range(total):
+            targets = message_targets(sender, total, messages, fanout, seed)
+            expected += sum(1 for target in targets if target in local)
+            if sender in local:
+                schedules[sender] = targets
+        sent = 0
+        for round_number in range(messages):
+            for sender, targets in schedules.items():
+                key = f"{sender}-{round_number}"
+                local[sender].send_text_message(f"{key} {time.time():.6f}",
+                                                (addresses[targets[round_number]], SIM_SESSION_PORT))
+                sent += 1
+            time.sleep(1.0 / rate)
+
+        deadline = time.time() + drain_timeout
+        while time.time() < deadline and sum(len(peer.latencies) for peer in peers) < expected:
+            time.sleep(POLL_INTERVAL)
+        wall_time = time.time() - started
+
+        memory_after = _peak_memory_kib()
+        return {
+            "peers": len(peers),
+            "convergence": [peer.converged_at for peer in peers],
+            "latencies": [latency for peer in peers for latency in peer.latencies.values()],
+            "sent": sent,
+            "expected": expected,
+            "cpu_seconds": time.process_time() - cpu_before,
+            "wall_seconds": wall_time,
+            "memory_kib": memory_after - memory_before if memory_before is not None else None,
+        }
+    finally:
+        for peer in peers:
+            peer.stop()
+        shutil.rmtree(data_root, ignore_errors=True)
+
+
+def run_simulation(peers=100, processes=1, **options):
+    """Spreads the peers over processes, runs them and returns the combined results."""
+    slices = [list(range(peers))[part::processes] for part in range(processes)]
+    start_at = time.time() + STARTUP_DELAY + PEER_STARTUP_DELAY * peers
+    if processes == 1:
+        results = [run_peers(slices[0], peers, start_at=start_at, **options)]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(run_peers, indices, peers, start_at=start_at, **options) for indices in slices]
+            results = [future.result() for future in futures]
+    return results
+
+
+def print_report(results, total):
+    convergence = [value for result in results for value in result["convergence"] if value is not None]
+    latencies = np.array([value for result in results for value in result["latencies"]]) * 1000
+    sent = sum(result["sent"] for result in results)
+    received = len(latencies)
+    print(f"[INFO] {total} peers in {len(results)} process(es)")
+    if convergence:
+        print(f"Discovery: {len(convergence)}/{total} converged, p50 {np.percentile(convergence, 50):.2f} s, "
+              f"p95 {np.percentile(convergence, 95):.2f} s, max {max(convergence):.2f} s")
+    else:
+        print(f"Discovery: 0/{total} converged")
+    lost = sent - received
+    print(f"Messages: sent {sent}, delivered {received}, lost {lost} ({lost / max(sent, 1):.1%})")
+    if received:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"Latency: p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms, max {latencies.max():.1f} ms")
+    for number, result in enumerate(results):
+        count = max(result["peers"], 1)
+        cpu_share = result["cpu_seconds"] / max(result["wall_seconds"], 1e-9) / count
+        memory = f"{result['memory_kib'] / count:.0f} KiB" if result["memory_kib"] is not None else "n/a"
+        print(f"Process {number}: per peer CPU {result['cpu_seconds'] / count * 1000:.1f} ms "
+              f"({cpu_share:.2%} of a core), peak memory {memory}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many virtual peers on loopback aliases and measure them.")
+    parser.add_argument("--peers", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each peer")
+    parser.add_argument("--fanout", type=int, default=3, help="distinct recipients per peer")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second per peer")
+    parser.add_argument("--broadcast-interval", type=float, default=BROADCAST_INTERVAL)
+    parser.add_argument("--discovery-timeout", type=float, default=30.0)
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = run_simulation(args.peers, args.processes, messages=args.messages, fanout=args.fanout,
+                             rate=args.rate, broadcast_interval=args.broadcast_interval,
+                             discovery_timeout=args.discovery_timeout, drain_timeout=args.drain_timeout,
+                             seed=args.seed)
+    print_report(results, args.peers)
@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+
+from working_backend import (AUDIO_SEQ, CallRecorder, CallRecording, PACKET_AUDIO, PACKET_VIDEO,
+                             PACKET_VIDEO_DELTA, TRACK_LOCAL, TRACK_REMOTE)
+
+
+def test_duration_is_the_last_packets_time(tmp_path):
+    path = str(tmp_path / "call.p2prec")
+    recorder = CallRecorder(path)
+    for seq in range(13):
+        recorder.add(TRACK_REMOTE, PACKET_AUDIO, AUDIO_SEQ.pack(seq) + bytes(64))
+        recorder.started -= 0.1  # Let 100 ms pass without sleeping
+    recorder.close(wait=True)
+    assert CallRecording(path).duration == pytest.approx(1.2, abs=0.05)
+
+
+def test_video_starts_at_a_keyframe_and_gaps_ask_for_one(tmp_path):
+    path = str(tmp_path / "call.p2prec")
+    gaps = []
+    recorder = CallRecorder(path, on_video_gap=gaps.append)
+    recorder.add(TRACK_REMOTE, PACKET_VIDEO_DELTA, b"delta from before the recording")
+    recorder.add(TRACK_REMOTE, PACKET_VIDEO, b"keyframe")
+    recorder.add(TRACK_REMOTE, PACKET_VIDEO_DELTA, b"delta")
+    assert recorder.stats["video_dropped"] == 1
+    recorder.add(TRACK_LOCAL, PACKET_VIDEO, b"keyframe")
+    recorder.video_limit = 0  # As if the disk had fallen behind
+    recorder.add(TRACK_LOCAL, PACKET_VIDEO_DELTA, b"delta")
+    assert gaps == [TRACK_LOCAL]
+    recorder.close(wait=True)
+    packets = [(track, packet_type) for _, track, packet_type, _ in CallRecording(path).packets()]
+    assert packets[:2] == [(TRACK_REMOTE, PACKET_VIDEO), (TRACK_REMOTE, PACKET_VIDEO_DELTA)]
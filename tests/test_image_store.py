@@ -0,0 +1,56 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+
+from working_backend import ImageStore
+
+
+def test_abandoned_partial_images_are_removed(tmp_path):
+    store = ImageStore(str(tmp_path), workers=0, partial_ttl=60)
+    partial = tmp_path / "partial"
+    store.add_chunk("a" * 64, 0, 3, b"first")
+    stale = time.time() - 120
+    os.utime(partial / ("a" * 64), (stale, stale))
+    # Starting another transfer clears out the one that stopped receiving chunks
+    store.add_chunk("b" * 64, 0, 3, b"second")
+    assert os.listdir(partial) == ["b" * 64]
+
+
+def test_active_partial_images_are_kept(tmp_path):
+    store = ImageStore(str(tmp_path), workers=0, partial_ttl=60)
+    store.add_chunk("a" * 64, 0, 2, b"first")
+    ImageStore(str(tmp_path), workers=0, partial_ttl=60)
+    assert os.listdir(tmp_path / "partial") == ["a" * 64]
+
+
+@pytest.mark.parametrize("digest, index, count", [
+    ("../../victim", 0, 1),
+    ("A" * 64, 0, 1),
+    ("a" * 64, 1, 1),
+    ("a" * 64, -1, 2),
+    ("a" * 64, 0, 10 ** 6),
+])
+def test_invalid_chunks_do_not_touch_the_filesystem(tmp_path, digest, index, count):
+    victim = tmp_path / "victim"
+    victim.mkdir()
+    (victim / "keep").write_bytes(b"keep")
+    store = ImageStore(str(tmp_path / "images"), workers=0)
+    assert not store.add_chunk(digest, index, count, b"data")
+    assert (victim / "keep").exists()
+    assert os.listdir(tmp_path / "images" / "partial") == []
+
+
+def test_chunks_assemble_into_the_image(tmp_path):
+    data = os.urandom(1000)
+    digest = hashlib.sha256(data).hexdigest()
+    store = ImageStore(str(tmp_path), workers=0)
+    assert not store.add_chunk(digest, 1, 2, data[500:])
+    assert store.add_chunk(digest, 0, 2, data[:500])
+    with open(store.path(digest), "rb") as f:
+        assert f.read() == data
+    assert os.listdir(tmp_path / "partial") == []
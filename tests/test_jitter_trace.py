@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+
+from working_backend import JitterBuffer, load_jitter_trace, replay_jitter_trace, save_jitter_trace
+
+
+def jittery_arrivals(count, chunk_duration, jitter=0.02, loss=0.02, seed=1):
+    """Arrival times of count chunks sent every chunk_duration over a jittery, lossy link."""
+    rng = random.Random(seed)
+    return [(seq, 100.0 + seq * chunk_duration + rng.uniform(0, jitter))
+            for seq in range(count) if rng.random() >= loss]
+
+
+def test_stored_trace_replays_like_the_original(tmp_path):
+    chunk_duration = JitterBuffer().chunk_duration
+    arrivals = jittery_arrivals(500, chunk_duration)
+    path = tmp_path / "call.trace"
+    save_jitter_trace(path, arrivals)
+    loaded = load_jitter_trace(path)
+    assert [seq for seq, _ in loaded] == [seq for seq, _ in arrivals]
+    stats = replay_jitter_trace(loaded)
+    assert stats == pytest.approx(replay_jitter_trace(arrivals), abs=0.01)
+    assert stats["played"] > 0.9 * len(arrivals)
+    assert stats["mean_delay_ms"] > 0
+
+
+def test_recorded_buffer_trace_round_trips(tmp_path):
+    trace = []
+    buffer = JitterBuffer(trace=trace)
+    for seq, arrival in jittery_arrivals(50, buffer.chunk_duration):
+        buffer.push(seq, buffer.silence, arrival)
+    path = tmp_path / "buffer.trace"
+    save_jitter_trace(path, trace)
+    assert load_jitter_trace(path) == [(seq, round(arrival, 6)) for seq, arrival in trace]
+
+
+def test_empty_trace_returns_zeroed_stats(tmp_path):
+    path = tmp_path / "empty.trace"
+    save_jitter_trace(path, [])
+    stats = replay_jitter_trace(load_jitter_trace(path))
+    assert stats["played"] == 0
+    assert stats["mean_delay_ms"] == 0.0
+    assert stats["max_delay_ms"] == 0.0
@@ -0,0 +1,92 @@
+import collections
+import os
+import time
+
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+
+from working_backend import OUTBOX_RETRY_INTERVAL, STREAM_TEXT, Outbox, Peer
+
+IP = "192.168.1.20"
+
+
+def bodies(outbox, ip=IP):
+    return [body for _, _, body in outbox.due(ip, limit=1000)]
+
+
+def test_order_survives_a_restart(tmp_path):
+    outbox = Outbox(str(tmp_path))
+    for n in range(3):
+        outbox.add(IP, STREAM_TEXT, b"before %d" % n)
+    # A new Outbox recovers the next sequence number from the file names
+    restarted = Outbox(str(tmp_path))
+    for n in range(3):
+        restarted.add(IP, STREAM_TEXT, b"after %d" % n)
+    assert bodies(restarted) == [b"before 0", b"before 1", b"before 2", b"after 0", b"after 1", b"after 2"]
+
+
+def test_count_limit_drops_the_oldest(tmp_path):
+    outbox = Outbox(str(tmp_path), max_messages=3)
+    for n in range(5):
+        outbox.add(IP, STREAM_TEXT, b"%d" % n)
+    assert bodies(outbox) == [b"2", b"3", b"4"]
+
+
+def test_byte_limit_drops_the_oldest(tmp_path):
+    outbox = Outbox(str(tmp_path), max_bytes=2500)
+    for n in range(4):
+        outbox.add(IP, STREAM_TEXT, bytes([n]) * 1000)
+    assert [body[0] for body in bodies(outbox)] == [2, 3]
+
+
+def test_expired_messages_are_dropped(tmp_path):
+    outbox = Outbox(str(tmp_path), ttl=60)
+    outbox.add(IP, STREAM_TEXT, b"old")
+    outbox.add(IP, STREAM_TEXT, b"new")
+    old_path = min(os.scandir(tmp_path / IP), key=lambda entry: entry.name).path
+    stale = time.time() - 120
+    os.utime(old_path, (stale, stale))
+    assert bodies(outbox) == [b"new"]
+    assert len(os.listdir(tmp_path / IP)) == 1
+
+
+def test_sent_messages_are_not_due_until_retry_or_reset(tmp_path):
+    outbox = Outbox(str(tmp_path))
+    first = outbox.add(IP, STREAM_TEXT, b"first")
+    outbox.add(IP, STREAM_TEXT, b"second")
+    outbox.mark_sent(IP, first)
+    assert bodies(outbox) == [b"second"]
+    # As if OUTBOX_RETRY_INTERVAL had passed
+    outbox._sent_at[IP][first] -= OUTBOX_RETRY_INTERVAL
+    assert bodies(outbox) == [b"first", b"second"]
+    outbox.mark_sent(IP, first)
+    outbox.reset_sent(IP)
+    assert bodies(outbox) == [b"first", b"second"]
+
+
+def test_receipt_removes_the_message(tmp_path):
+    outbox = Outbox(str(tmp_path))
+    first = outbox.add(IP, STREAM_TEXT, b"first")
+    outbox.add(IP, STREAM_TEXT, b"second")
+    outbox.remove(IP, first)
+    assert bodies(outbox) == [b"second"]
+    assert outbox.has_pending(IP)
+    outbox.remove(IP, outbox.due(IP)[0][0])
+    assert not outbox.has_pending(IP)
+
+
+def test_duplicate_messages_are_delivered_once():
+    # Only what handle_queued_message touches, without sockets or audio
+    peer = Peer.__new__(Peer)
+    peer.delivered_messages = collections.OrderedDict()
+    delivered, receipts = [], []
+    peer.handle_text_message = lambda message, addr: delivered.append(message)
+    peer.send_control_message = lambda message, addr: receipts.append(message["id"])
+    envelope = {"id": "abc", "stream": STREAM_TEXT, "body": b"hello"}
+    for _ in range(3):
+        peer.handle_queued_message(STREAM_TEXT, envelope, (IP, 0))
+    assert delivered == ["hello"]
+    # Every copy is confirmed, so the sender stops resending it
+    assert receipts == ["abc", "abc", "abc"]
@@ -0,0 +1,126 @@
+import os
+import socket
+import threading
+
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+
+from working_backend import (FLAG_MORE, FRAME_HEADER, SESSION_FRAGMENT_SIZE, STREAM_CONTROL, STREAM_FILE,
+                             STREAM_KEEPALIVE, STREAM_TEXT, STREAM_VOICE, PeerSession)
+
+
+class Receiver:
+    """Collects the messages and the close of a PeerSession."""
+
+    def __init__(self, expected=0):
+        self.messages = []
+        self.expected = expected
+        self.received = threading.Event()
+        self.closed = threading.Event()
+
+    def on_message(self, session, stream_id, payload):
+        self.messages.append((stream_id, payload))
+        if len(self.messages) >= self.expected:
+            self.received.set()
+
+    def on_close(self, session):
+        self.closed.set()
+
+
+def session_pair(receiver):
+    """A started sending and receiving session over a socketpair."""
+    a, b = socket.socketpair()
+    sender = PeerSession(a, "sender", True, lambda *args: None, lambda session: None)
+    receiving = PeerSession(b, "receiver", False, receiver.on_message, receiver.on_close)
+    return sender, receiving
+
+
+def read_frames(sock, count):
+    """Reads count raw frames, skipping keepalives; returns (stream id, flags, data) of each."""
+    frames = []
+    reader = sock.makefile("rb")
+    while len(frames) < count:
+        stream_id, flags, length = FRAME_HEADER.unpack(reader.read(FRAME_HEADER.size))
+        data = reader.read(length)
+        if stream_id != STREAM_KEEPALIVE:
+            frames.append((stream_id, flags, data))
+    return frames
+
+
+def test_large_message_is_fragmented_and_reassembled():
+    receiver = Receiver(expected=2)
+    sender, receiving = session_pair(receiver)
+    big = os.urandom(5 * SESSION_FRAGMENT_SIZE + 123)
+    sender.start()
+    receiving.start()
+    try:
+        assert sender.send(STREAM_FILE, big)
+        assert sender.send(STREAM_CONTROL, b"")
+        assert receiver.received.wait(5)
+        assert sorted(receiver.messages) == sorted([(STREAM_FILE, big), (STREAM_CONTROL, b"")])
+    finally:
+        sender.close()
+        receiving.close()
+
+
+def test_fragments_are_at_most_the_fragment_size():
+    a, b = socket.socketpair()
+    sender = PeerSession(a, "sender", True, lambda *args: None, lambda session: None)
+    big = os.urandom(3 * SESSION_FRAGMENT_SIZE + 1)
+    assert sender.send(STREAM_FILE, big)
+    sender.start()
+    try:
+        frames = read_frames(b, 4)
+        assert [len(data) for _, _, data in frames] == [SESSION_FRAGMENT_SIZE] * 3 + [1]
+        assert [flags & FLAG_MORE for _, flags, _ in frames] == [FLAG_MORE] * 3 + [0]
+        assert b"".join(data for _, _, data in frames) == big
+    finally:
+        sender.close()
+        b.close()
+
+
+def test_streams_are_interleaved_by_priority_and_round_robin():
+    a, b = socket.socketpair()
+    sender = PeerSession(a, "sender", True, lambda *args: None, lambda session: None)
+    # Queued before the writer starts, so the order below is the scheduler's alone
+    assert sender.send(STREAM_FILE, os.urandom(3 * SESSION_FRAGMENT_SIZE))
+    assert sender.send(STREAM_VOICE, os.urandom(3 * SESSION_FRAGMENT_SIZE))
+    assert sender.send(STREAM_TEXT, b"hello")
+    sender.start()
+    try:
+        streams = [stream_id for stream_id, _, _ in read_frames(b, 7)]
+        # Text has the higher priority; file and voice share a class and take turns
+        assert streams == [STREAM_TEXT] + [STREAM_FILE, STREAM_VOICE] * 3
+    finally:
+        sender.close()
+        b.close()
+
+
+def test_interleaved_messages_are_reassembled_per_stream():
+    receiver = Receiver(expected=2)
+    sender, receiving = session_pair(receiver)
+    file_data = os.urandom(4 * SESSION_FRAGMENT_SIZE)
+    voice_data = os.urandom(4 * SESSION_FRAGMENT_SIZE + 7)
+    assert sender.send(STREAM_FILE, file_data)
+    assert sender.send(STREAM_VOICE, voice_data)
+    sender.start()
+    receiving.start()
+    try:
+        assert receiver.received.wait(5)
+        assert dict(receiver.messages) == {STREAM_FILE: file_data, STREAM_VOICE: voice_data}
+    finally:
+        sender.close()
+        receiving.close()
+
+
+def test_session_closes_on_eof():
+    receiver = Receiver()
+    a, b = socket.socketpair()
+    receiving = PeerSession(b, "receiver", False, receiver.on_message, receiver.on_close)
+    receiving.start()
+    a.close()
+    assert receiver.closed.wait(5)
+    assert not receiving.alive
+    assert not receiving.send(STREAM_TEXT, b"too late")
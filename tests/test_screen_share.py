@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+cv2 = pytest.importorskip("cv2")
+
+from working_backend import PACKET_VIDEO, PACKET_VIDEO_DELTA, SyntheticSource, TileCanvas, TileDeltaEncoder
+
+
+def desktop_frames(count, width=800, height=600):
+    """Screen-like frames: a window of text that gains a line per frame, and a cursor that moves."""
+    rng = np.random.default_rng(0)
+    desktop = np.full((height, width, 3), (90, 60, 30), dtype=np.uint8)
+    cv2.rectangle(desktop, (40, 40), (width - 40, height - 40), (250, 250, 250), -1)
+    for n in range(count):
+        line = "".join(chr(c) for c in rng.integers(33, 127, 40))
+        cv2.putText(desktop, line, (50, 70 + (n % 25) * 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+        frame = desktop.copy()
+        x, y = 100 + n * 13 % 600, 100 + n * 7 % 400
+        cv2.rectangle(frame, (x, y), (x + 8, y + 14), (0, 0, 255), -1)
+        # A single changed pixel has to arrive too
+        frame[height - 1, width - 1 - n % width] = (n % 256, 0, 0)
+        yield frame
+
+
+def test_screen_frames_arrive_pixel_exact():
+    source = SyntheticSource(desktop_frames(60), fps=1000)
+    encoder = TileDeltaEncoder(threshold=source.tile_threshold, keyframe_interval=source.keyframe_interval)
+    canvas = TileCanvas()
+    packet_types = []
+    seq = 0
+    while True:
+        frame = source.read()
+        if frame is None:
+            break
+        prepared = encoder.prepare(seq, frame)
+        if prepared is not None:
+            packet_type, data = prepared
+            header, image = data if packet_type == PACKET_VIDEO_DELTA else (b"", data)
+            ok, encoded = cv2.imencode(source.image_format, image, source.encode_params)
+            assert ok
+            payload = header + encoded.tobytes()
+            if packet_type == PACKET_VIDEO:
+                canvas.apply_keyframe(cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR))
+            else:
+                assert canvas.apply_delta(payload)
+            encoder.acknowledge(seq)
+            packet_types.append(packet_type)
+        assert np.array_equal(canvas.picture(), frame), seq
+        seq += 1
+    source.release()
+    assert seq == 60
+    assert packet_types.count(PACKET_VIDEO) == 1
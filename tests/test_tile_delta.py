@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pyaudio")
+pytest.importorskip("noisereduce")
+cv2 = pytest.importorskip("cv2")
+
+from working_backend import (MediaSendQueue, TileCanvas, TileDeltaEncoder, PACKET_VIDEO,
+                             PACKET_VIDEO_DELTA)
+
+PNG = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+def moving_square(count, width=640, height=480, size=48):
+    """A static gradient with a square moving across it, one frame per step."""
+    background = np.zeros((height, width, 3), dtype=np.uint8)
+    background[:] = np.linspace(0, 255, width, dtype=np.uint8)[None, :, None]
+    for n in range(count):
+        frame = background.copy()
+        x = (n * 7) % (width - size)
+        frame[100:100 + size, x:x + size] = (255, 255, 255)
+        yield frame
+
+
+def encode(packet_type, data):
+    if packet_type == PACKET_VIDEO_DELTA:
+        header, image = data
+    else:
+        header, image = b"", data
+    ok, encoded = cv2.imencode('.png', image, PNG)
+    assert ok
+    return header + encoded.tobytes()
+
+
+def decode(canvas, packet_type, payload):
+    if packet_type == PACKET_VIDEO:
+        canvas.apply_keyframe(cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR))
+    else:
+        assert canvas.apply_delta(payload)
+
+
+@pytest.mark.parametrize("lag", [1, 2, 3])
+def test_lagging_acks_do_not_cascade_keyframes(lag):
+    encoder = TileDeltaEncoder(threshold=0, keyframe_interval=3600)
+    outgoing = MediaSendQueue(on_keyframe_dropped=encoder.request_keyframe)
+    canvas = TileCanvas()
+    in_flight = []
+    keyframes = 0
+    for seq, frame in enumerate(moving_square(100)):
+        prepared = encoder.prepare(seq, frame)
+        if prepared is not None:
+            packet_type, data = prepared
+            outgoing.put_video(seq, packet_type, encode(packet_type, data))
+        item = outgoing.get(timeout=0)
+        if item is not None:
+            packet_type, sent_seq, payload = item
+            keyframes += packet_type == PACKET_VIDEO
+            decode(canvas, packet_type, payload)
+            in_flight.append(sent_seq)
+            assert np.array_equal(canvas.picture(), frame)
+        # The network confirms each frame a few frames after it was sent
+        if len(in_flight) > lag:
+            encoder.acknowledge(in_flight.pop(0))
+    assert keyframes == 1
+
+
+def test_queued_keyframe_is_not_replaced_by_delta():
+    dropped = []
+    outgoing = MediaSendQueue(on_keyframe_dropped=lambda: dropped.append(True))
+    outgoing.put_video(1, PACKET_VIDEO, b"key")
+    outgoing.put_video(2, PACKET_VIDEO_DELTA, b"delta")
+    assert outgoing.get(timeout=0) == (PACKET_VIDEO, 1, b"key")
+    assert not dropped
+
+
+def test_delta_waits_for_keyframe_still_encoding():
+    outgoing = MediaSendQueue()
+    outgoing.expect_keyframe(5)
+    outgoing.put_video(6, PACKET_VIDEO_DELTA, b"delta")
+    outgoing.put_video(5, PACKET_VIDEO, b"key")
+    assert outgoing.get(timeout=0) == (PACKET_VIDEO, 5, b"key")
+    assert outgoing.get(timeout=0) is None
+
+
+def test_dropped_keyframe_requests_another():
+    encoder = TileDeltaEncoder()
+    outgoing = MediaSendQueue(on_keyframe_dropped=encoder.request_keyframe)
+    outgoing.put_video(3, PACKET_VIDEO_DELTA, b"delta")
+    outgoing.get(timeout=0)
+    outgoing.put_video(2, PACKET_VIDEO, b"key")
+    assert encoder._keyframe_requested
@@ -3,26 +3,1442 @@ import socket
 import threading
 import pickle
 import struct
+import time
+import queue
+import collections
+import uuid
+import hashlib
+import wave
 import cv2
 import pyaudio
 import numpy as np
 import noisereduce as nr
 
+try:
+    import mss  # Only needed for screen sharing
+except ImportError:
+    mss = None
+
 # Constants
 BROADCAST_PORT = 5001
-VIDEO_PORT = 5003
-CONTROL_PORT = 5005
-TEXT_PORT = 5007
-VOICE_PORT = 5009
+SESSION_PORT = 5011
+BROADCAST_ADDRESSES = ("255.255.255.255",)
+BROADCAST_INTERVAL = 5.0  # Seconds between presence announcements
 BUFFER_SIZE = 4096
 FRAME_WIDTH, FRAME_HEIGHT = 640, 480
 CHUNK = 4096
+CALL_CHUNK = 1024  # Samples per call audio packet, about 23 ms
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 44100
+JPEG_QUALITY = 80
+ENCODE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+CAPTURE_QUEUE_SIZE = 2
+AUDIO_QUEUE_SIZE = 32
+DECODE_TIME_SMOOTHING = 0.1
+VIDEO_QUEUE_SIZE = 30
+VIDEO_DELTA_MODE = True
+TILE_SIZE = 32
+TILE_DIFF_THRESHOLD = 6  # Mean absolute difference per pixel channel that marks a tile as changed
+KEYFRAME_INTERVAL = 5.0  # Seconds
+KEYFRAME_FRACTION = 0.6  # Send a keyframe instead once this share of tiles is pending
+SCREEN_FPS = 10
+SCREEN_KEYFRAME_INTERVAL = 30.0  # Seconds; screen keyframes are large and rarely needed
+PNG_COMPRESSION = 1  # Fastest zlib level; screen content compresses well regardless
+
+# Peer sessions
+SESSION_FRAGMENT_SIZE = 16 * 1024
+SESSION_QUEUE_BYTES = 1024 * 1024  # Per stream
+KEEPALIVE_INTERVAL = 5.0
+KEEPALIVE_TIMEOUT = 15.0
+CONNECT_TIMEOUT = 3.0
+RECONNECT_DELAYS = (0.2, 1.0, 3.0)
+# How long the side that did not dial waits for the other one to reconnect before ending a call
+RECONNECT_GRACE = sum(RECONNECT_DELAYS) + len(RECONNECT_DELAYS) * CONNECT_TIMEOUT
+
+# Call audio playout
+JITTER_MIN_DEPTH = 2  # Chunks
+JITTER_MAX_DEPTH = 20
+JITTER_MULTIPLIER = 3  # Target delay in multiples of the measured jitter
+CONCEAL_FADE = 0.5  # Gain applied per consecutive concealed chunk
+CONCEAL_MAX_REPEATS = 3
+
+# Voice activity detection
+VAD_MIN_RMS = 300  # Chunks quieter than this are never speech
+VAD_ENERGY_RATIO = 3.0  # Speech must be this much louder than the noise floor
+VAD_MAX_ZCR = 0.25  # Zero crossings per sample; above this a moderately loud chunk is hiss
+VAD_FLOOR_ADAPT = 0.05  # How fast the noise floor follows non-speech chunks
+VAD_CALL_HANGOVER = 8  # Call chunks still sent after speech stops, about 190 ms
+VAD_NOTE_HANGOVER = 3  # Voice note chunks kept after speech stops, about 280 ms
+COMFORT_NOISE_INTERVAL = 10  # Silent call chunks per comfort-noise marker
+
+# Store-and-forward outbox
+DATA_DIR = os.path.join(os.path.expanduser("~"), ".p2p_messenger")
+OUTBOX_MAX_MESSAGES = 500  # Per peer
+OUTBOX_MAX_BYTES = 64 * 1024 * 1024  # Per peer
+OUTBOX_TTL = 7 * 24 * 3600  # Seconds
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_RETRY_INTERVAL = 30.0  # Seconds before an unconfirmed message is sent again
+DELIVERED_HISTORY = 1000  # Received message ids remembered to drop duplicates
+
+# Image messages
+IMAGE_CHUNK_SIZE = 256 * 1024  # Each chunk is its own outbox message, so a transfer resumes where it stopped
+IMAGE_MAX_BYTES = 32 * 1024 * 1024
+IMAGE_MAX_CHUNKS = IMAGE_MAX_BYTES // IMAGE_CHUNK_SIZE + 1
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+THUMBNAIL_SIZE = 200  # Longest side in pixels
+THUMBNAIL_CACHE_SIZE = 256  # Decoded thumbnails kept in memory
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_QUALITY = 85
+REDUCED_DECODE_BYTES = 512 * 1024  # Larger files are first decoded at 1/4 scale
+
+# Call recording
+RECORDING_QUEUE_SIZE = 512  # Packets waiting for the writer
+RECORDING_VIDEO_SHARE = 0.5  # Video is only queued while the queue is less full than this; audio may use the rest
+RECORDING_INDEX_INTERVAL = 1.0  # Seconds between audio index entries
+RECORDING_BUFFER = 1024 * 1024
+RECORDING_MAGIC = b"P2PREC1\n"
+RECORD_HEADER = struct.Struct('>dBBI')  # Seconds since start, track, packet type, payload length
+INDEX_ENTRY = struct.Struct('>dBBQ')  # Seconds since start, track, packet type, file offset
+INDEX_TRAILER = struct.Struct('>Q8s')  # Index offset, INDEX_MAGIC
+INDEX_MAGIC = b"P2PINDEX"
+TRACK_LOCAL = 0
+TRACK_REMOTE = 1
+
+# Streams multiplexed over a peer session
+STREAM_CONTROL = 0
+STREAM_TEXT = 1
+STREAM_VOICE = 2
+STREAM_FILE = 3
+STREAM_MEDIA = 4  # Call video
+STREAM_CALL_AUDIO = 5
+STREAM_KEEPALIVE = 255
+STREAM_QUEUE_LIMITS = {STREAM_MEDIA: 128 * 1024, STREAM_CALL_AUDIO: 32 * 1024}  # Keep call media latency low
+# Egress priority classes, lower is sent first
+STREAM_PRIORITIES = {STREAM_CALL_AUDIO: 0, STREAM_CONTROL: 1, STREAM_MEDIA: 2, STREAM_TEXT: 3,
+                     STREAM_VOICE: 4, STREAM_FILE: 4}
+
+# Egress pacing, shared by all sessions
+EGRESS_BANDWIDTH = 6 * 1024 * 1024  # Default bytes per second, kept below the link rate so queues form here, not in the network
+EGRESS_BURST = 64 * 1024
+EGRESS_RESERVE_STEP = 4 * 1024  # Tokens each priority class leaves untouched for the classes above it
+AUDIO_LATENCY_TARGET = 0.05  # Seconds; bounds how long one fragment may hold up call audio
+MEDIA_SEND_WAIT = 0.02  # Seconds a video packet may wait for queue room before it is skipped
+FRAME_HEADER = struct.Struct('>BBI')  # Stream id, flags, payload length
+FLAG_MORE = 1  # More fragments of the same message follow
+
+# Media packet types sent on STREAM_MEDIA and STREAM_CALL_AUDIO, as the first payload byte
+PACKET_VIDEO = 1  # Full JPEG frame, also used as a keyframe in delta mode
+PACKET_AUDIO = 2
+PACKET_VIDEO_DELTA = 3  # Changed tiles only, see TileDeltaEncoder
+PACKET_COMFORT_NOISE = 4  # Sender went silent; carries the background noise level
+AUDIO_SEQ = struct.Struct('>I')  # Prefix of PACKET_AUDIO and PACKET_COMFORT_NOISE payloads
+COMFORT_NOISE = struct.Struct('>H')
+DELTA_HEADER = struct.Struct('>HHHH')  # Frame width, frame height, tile size, tile count
+
+
+def put_latest(q, item):
+    """Puts item on a bounded queue, discarding the oldest entries while it is full; returns those discarded."""
+    discarded = []
+    while True:
+        try:
+            q.put_nowait(item)
+            return discarded
+        except queue.Full:
+            try:
+                discarded.append(q.get_nowait())
+            except queue.Empty:
+                pass
+
+
+def pad_to_tiles(frame, tile_size):
+    """Extends frame on the bottom and right so both sides are multiples of tile_size."""
+    height, width = frame.shape[:2]
+    pad_bottom, pad_right = -height % tile_size, -width % tile_size
+    if pad_bottom or pad_right:
+        frame = cv2.copyMakeBorder(frame, 0, pad_bottom, 0, pad_right, cv2.BORDER_REPLICATE)
+    return frame
+
+
+def tile_view(frame, tile_size):
+    """Returns a (rows, cols, tile, tile, channels) view of a tile-aligned frame."""
+    height, width, channels = frame.shape
+    return frame.reshape(height // tile_size, tile_size, width // tile_size, tile_size, channels).swapaxes(1, 2)
+
+
+def tiles_to_mosaic(tiles):
+    """Packs an (n, tile, tile, channels) array into one roughly square image."""
+    count, tile_size, _, channels = tiles.shape
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = -(-count // cols)
+    grid = np.zeros((rows * cols, tile_size, tile_size, channels), dtype=tiles.dtype)
+    grid[:count] = tiles
+    return grid.reshape(rows, cols, tile_size, tile_size, channels).swapaxes(1, 2).reshape(
+        rows * tile_size, cols * tile_size, channels)
+
+
+def mosaic_to_tiles(mosaic, tile_size, count):
+    """Inverse of tiles_to_mosaic."""
+    return tile_view(mosaic, tile_size).reshape(-1, tile_size, tile_size, mosaic.shape[2])[:count]
+
+
+class CameraSource:
+    """Webcam frames from cv2.VideoCapture."""
+
+    image_format = '.jpg'
+    encode_params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+    tile_threshold = TILE_DIFF_THRESHOLD
+    keyframe_interval = KEYFRAME_INTERVAL
+
+    def __init__(self, index=0, width=FRAME_WIDTH, height=FRAME_HEIGHT):
+        self.cap = cv2.VideoCapture(index)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def read(self):
+        """Returns the next BGR frame, or None when the camera stops delivering."""
+        if not self.cap.isOpened():
+            return None
+        ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def release(self):
+        self.cap.release()
+
+
+class ScreenSource:
+    """A screen region at native resolution, captured with mss.
+
+    Screen content has no sensor noise, so any pixel change marks a tile as
+    changed, and tiles are sent as lossless PNG so text stays sharp. Capture is
+    paced to SCREEN_FPS to bound CPU use on large displays. Under Xvfb this
+    captures the virtual display, which is how it can be exercised on Linux CI.
+    """
+
+    image_format = '.png'
+    encode_params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    tile_threshold = 0
+    keyframe_interval = SCREEN_KEYFRAME_INTERVAL
+
+    def __init__(self, region=None, monitor=1, fps=SCREEN_FPS):
+        if mss is None:
+            raise RuntimeError("Screen sharing requires the mss package (pip install mss)")
+        self.region = region
+        self.monitor = monitor
+        self.frame_interval = 1 / fps
+        self._next_frame = time.monotonic()
+        self._screen = None
+
+    def read(self):
+        """Returns the next BGR capture of the region."""
+        delay = self._next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame = max(self._next_frame + self.frame_interval, time.monotonic())
+        if self._screen is None:
+            # mss handles must be created on the thread that uses them
+            self._screen = mss.mss()
+        shot = self._screen.grab(self.region or self._screen.monitors[self.monitor])
+        return cv2.cvtColor(np.asarray(shot), cv2.COLOR_BGRA2BGR)
+
+    def release(self):
+        if self._screen is not None:
+            self._screen.close()
+            self._screen = None
+
+
+class SyntheticSource:
+    """Plays back an iterable of BGR frames at a fixed rate, for tests without a camera or display."""
+
+    image_format = '.png'
+    encode_params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    tile_threshold = 0
+    keyframe_interval = KEYFRAME_INTERVAL
+
+    def __init__(self, frames, fps=30):
+        self.frames = iter(frames)
+        self.frame_interval = 1 / fps
+        self._next_frame = time.monotonic()
+
+    def read(self):
+        delay = self._next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame = max(self._next_frame + self.frame_interval, time.monotonic())
+        return next(self.frames, None)
+
+    def release(self):
+        pass
+
+
+class TileDeltaEncoder:
+    """Decides, per captured frame, which tiles the receiver is missing.
+
+    A tile counts as changed when it differs enough from the content last
+    emitted for it. Frames may be dropped between here and the socket, so a
+    delta carries every tile changed since the last frame that was actually
+    sent (see acknowledge), which keeps the receiver's canvas consistent.
+    A keyframe counts as sent as soon as it is prepared: the send path never
+    drops one silently, it calls request_keyframe instead. Otherwise every
+    frame prepared while a keyframe is in flight would look fully changed
+    and become a keyframe too.
+    """
+
+    def __init__(self, tile_size=TILE_SIZE, threshold=TILE_DIFF_THRESHOLD,
+                 keyframe_interval=KEYFRAME_INTERVAL, keyframe_fraction=KEYFRAME_FRACTION):
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_fraction = keyframe_fraction
+        self._reference = None
+        self._changed_seq = None
+        self._acked_seq = -1
+        self._keyframe_seq = -1
+        self._last_keyframe = 0.0
+        self._keyframe_requested = False
+
+    def request_keyframe(self):
+        """Makes the next prepared frame a keyframe."""
+        self._keyframe_requested = True
+
+    def acknowledge(self, seq):
+        """Records that frame seq has been handed to the network."""
+        self._acked_seq = max(self._acked_seq, seq)
+
+    def prepare(self, seq, frame):
+        """Returns (PACKET_VIDEO, frame), (PACKET_VIDEO_DELTA, (header, mosaic)) or None if nothing changed."""
+        height, width = frame.shape[:2]
+        padded = pad_to_tiles(frame, self.tile_size)
+        now = time.monotonic()
+        if (self._reference is None or self._reference.shape != padded.shape or self._keyframe_requested
+                or now - self._last_keyframe >= self.keyframe_interval):
+            return self._keyframe(seq, padded, frame, now)
+
+        tiles = tile_view(padded, self.tile_size)
+        reference_tiles = tile_view(self._reference, self.tile_size)
+        diff = cv2.absdiff(padded, self._reference)
+        rows, cols = tiles.shape[:2]
+        energy = diff.reshape(rows, self.tile_size, cols, -1).sum(axis=(1, 3), dtype=np.uint32)
+        changed = energy > self.threshold * diff[0, 0].size * self.tile_size * self.tile_size
+        reference_tiles[changed] = tiles[changed]
+        self._changed_seq[changed] = seq
+
+        pending = self._changed_seq > max(self._acked_seq, self._keyframe_seq)
+        count = np.count_nonzero(pending)
+        if count == 0:
+            return None
+        if count >= self.keyframe_fraction * pending.size:
+            return self._keyframe(seq, padded, frame, now)
+        indices = np.flatnonzero(pending).astype('>u2')
+        header = DELTA_HEADER.pack(width, height, self.tile_size, count) + indices.tobytes()
+        return PACKET_VIDEO_DELTA, (header, tiles_to_mosaic(tiles[pending]))
+
+    def _keyframe(self, seq, padded, frame, now):
+        self._reference = padded.copy()
+        rows, cols = tile_view(padded, self.tile_size).shape[:2]
+        self._changed_seq = np.full((rows, cols), seq, dtype=np.int64)
+        self._keyframe_seq = seq
+        self._last_keyframe = now
+        self._keyframe_requested = False
+        return PACKET_VIDEO, frame
+
+
+class TileCanvas:
+    """Receiver-side picture that keyframes replace and tile deltas patch in place."""
+
+    def __init__(self):
+        self.frame = None
+        self.size = None
+
+    def apply_keyframe(self, frame):
+        self.frame = frame
+        self.size = (frame.shape[1], frame.shape[0])
+
+    def apply_delta(self, payload):
+        """Patches the tiles of a PACKET_VIDEO_DELTA payload; returns False if it does not fit the canvas."""
+        width, height, tile_size, count = DELTA_HEADER.unpack_from(payload)
+        if self.frame is None or self.size != (width, height):
+            return False
+        indices = np.frombuffer(payload, dtype='>u2', count=count, offset=DELTA_HEADER.size)
+        mosaic_data = np.frombuffer(payload, dtype=np.uint8, offset=DELTA_HEADER.size + indices.nbytes)
+        mosaic = cv2.imdecode(mosaic_data, cv2.IMREAD_COLOR)
+        if mosaic is None:
+            return False
+        canvas = pad_to_tiles(self.frame, tile_size)
+        canvas_tiles = tile_view(canvas, tile_size)
+        rows, cols = np.divmod(indices.astype(np.intp), canvas_tiles.shape[1])
+        canvas_tiles[rows, cols] = mosaic_to_tiles(mosaic, tile_size, count)
+        self.frame = canvas
+        return True
+
+    def picture(self):
+        """Returns the current picture cropped to the sender's frame size."""
+        width, height = self.size
+        return self.frame[:height, :width]
+
+
+class VideoPacketQueue:
+    """Received video packets waiting for the decoder; a keyframe supersedes everything before it."""
+
+    def __init__(self, max_packets=VIDEO_QUEUE_SIZE):
+        self._cond = threading.Condition()
+        self._packets = collections.deque()
+        self.max_packets = max_packets
+        self.overflowed = False
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, packet_type, payload):
+        with self._cond:
+            if packet_type == PACKET_VIDEO:
+                self.dropped += len(self._packets)
+                self._packets.clear()
+            elif len(self._packets) >= self.max_packets:
+                # Deltas cannot be skipped, so wait for the next keyframe
+                self.dropped += len(self._packets) + 1
+                self._packets.clear()
+                self.overflowed = True
+                self._cond.notify()
+                return
+            self._packets.append((packet_type, payload))
+            self._cond.notify()
+
+    def get_all(self, timeout=None):
+        """Returns (packets, overflowed) with every queued packet in arrival order."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or self._packets or self.overflowed, timeout)
+            packets = list(self._packets)
+            self._packets.clear()
+            overflowed, self.overflowed = self.overflowed, False
+            return packets, overflowed
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class VoiceActivityDetector:
+    """Classifies 16-bit PCM chunks as speech or silence.
+
+    A chunk is speech when its RMS energy is well above a running noise floor,
+    unless it is only moderately loud and has the high zero-crossing rate of
+    hiss or fan noise. After speech, a few more chunks are reported as speech
+    (the hangover) so word endings and short pauses are not cut off.
+    """
+
+    def __init__(self, hangover=VAD_CALL_HANGOVER):
+        self.hangover = hangover
+        self.noise_floor = float(VAD_MIN_RMS) / VAD_ENERGY_RATIO
+        self._hangover_left = 0
+
+    def is_speech(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        if not len(samples):
+            return False
+        rms = float(np.sqrt(np.mean(samples * samples)))
+        zcr = np.count_nonzero(np.diff(np.signbit(samples))) / len(samples)
+        threshold = max(VAD_MIN_RMS, self.noise_floor * VAD_ENERGY_RATIO)
+        speech = rms > 2 * threshold or (rms > threshold and zcr < VAD_MAX_ZCR)
+        if speech:
+            self._hangover_left = self.hangover
+            return True
+        self.noise_floor += (rms - self.noise_floor) * VAD_FLOOR_ADAPT if rms > self.noise_floor else rms - self.noise_floor
+        if self._hangover_left:
+            self._hangover_left -= 1
+            return True
+        return False
+
+
+def trim_silence(chunks, hangover=VAD_NOTE_HANGOVER):
+    """Drops the silent chunks before the first and after the last speech in a recording."""
+    detector = VoiceActivityDetector(hangover)
+    speech = [detector.is_speech(chunk) for chunk in chunks]
+    if not any(speech):
+        return []
+    first = speech.index(True)
+    last = len(speech) - speech[::-1].index(True)
+    return chunks[max(first - 1, 0):last]
+
+
+class JitterBuffer:
+    """Receiver-side playout buffer for call audio.
+
+    Chunks are played in sequence order after a delay that follows the
+    inter-arrival jitter, estimated as in RFC 3550 from arrival times against
+    the send times implied by the sequence numbers. A chunk missing when its
+    turn comes is concealed by repeating the last one with a fade, and a chunk
+    arriving after its turn is discarded. When more is buffered than the
+    target, chunks are skipped to bring latency back down. After a
+    comfort-noise marker, gaps are filled with noise at the sender's
+    background level instead of being concealed.
+    """
+
+    def __init__(self, chunk_samples=CALL_CHUNK, rate=RATE, min_depth=JITTER_MIN_DEPTH,
+                 max_depth=JITTER_MAX_DEPTH, trace=None):
+        self.chunk_duration = chunk_samples / rate
+        self.silence = bytes(chunk_samples * CHANNELS * 2)
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.trace = trace  # Optional list that records (seq, arrival) for replay_jitter_trace
+        self.jitter = 0.0
+        self.stats = {"played": 0, "concealed": 0, "comfort": 0, "late": 0, "skipped": 0, "rebuffered": 0}
+        self._lock = threading.Lock()
+        self._chunks = {}
+        self._next_seq = None
+        self._last_transit = None
+        self._last_chunk = None
+        self._concealed_run = 0
+        self._comfort_level = None  # Noise RMS while the sender is silent
+        self._playing = False
+
+    @property
+    def target_depth(self):
+        depth = int(np.ceil(JITTER_MULTIPLIER * self.jitter / self.chunk_duration)) + 1
+        return min(max(depth, self.min_depth), self.max_depth)
+
+    def push(self, seq, pcm, arrival):
+        """Adds a received chunk; arrival is a time.monotonic() style timestamp."""
+        with self._lock:
+            if self.trace is not None:
+                self.trace.append((seq, arrival))
+            if self._track_arrival(seq, arrival):
+                self._chunks[seq] = pcm
+
+    def push_comfort_noise(self, seq, level, arrival):
+        """Notes that the sender is silent from seq on, with background noise of the given RMS."""
+        with self._lock:
+            if self._track_arrival(seq, arrival):
+                self._chunks[seq] = level
+
+    def _track_arrival(self, seq, arrival):
+        """Updates the jitter estimate; returns False for a chunk whose turn has passed."""
+        transit = arrival - seq * self.chunk_duration
+        if self._last_transit is not None:
+            self.jitter += (abs(transit - self._last_transit) - self.jitter) / 16
+        self._last_transit = transit
+        if self._next_seq is not None and seq < self._next_seq:
+            self.stats["late"] += 1
+            return False
+        return True
+
+    def pop(self):
+        """Returns (seq, pcm) for the next playout slot; seq is None while (re)buffering."""
+        with self._lock:
+            if not self._playing:
+                if len(self._chunks) < self.target_depth:
+                    return None, self.silence
+                self._playing = True
+                first = min(self._chunks)
+                self._next_seq = first if self._next_seq is None else max(self._next_seq, first)
+
+            while len(self._chunks) > self.target_depth + 1:
+                # Running behind: drop the oldest chunk, or skip a gap in front of it
+                oldest = min(self._chunks)
+                if oldest == self._next_seq:
+                    del self._chunks[oldest]
+                    self.stats["skipped"] += 1
+                self._next_seq += 1
+
+            seq = self._next_seq
+            self._next_seq += 1
+            pcm = self._chunks.pop(seq, None)
+            if isinstance(pcm, bytes):
+                self._concealed_run = 0
+                self._comfort_level = None
+                self._last_chunk = pcm
+                self.stats["played"] += 1
+                return seq, pcm
+            if pcm is not None:
+                self._comfort_level = pcm
+            if self._comfort_level is not None:
+                self.stats["comfort"] += 1
+                return seq, self._comfort_noise()
+            if not self._chunks:
+                # Nothing left to play: build up the target depth again
+                self._playing = False
+                self.stats["rebuffered"] += 1
+            return seq, self._conceal()
+
+    def _conceal(self):
+        """Repeats the last chunk with a falling gain, then plays silence."""
+        self._concealed_run += 1
+        self.stats["concealed"] += 1
+        if self._last_chunk is None or self._concealed_run > CONCEAL_MAX_REPEATS:
+            return self.silence
+        samples = np.frombuffer(self._last_chunk, dtype=np.int16)
+        start_gain = CONCEAL_FADE ** (self._concealed_run - 1)
+        end_gain = CONCEAL_FADE ** self._concealed_run if self._concealed_run < CONCEAL_MAX_REPEATS else 0.0
+        ramp = np.linspace(start_gain, end_gain, len(samples), dtype=np.float32)
+        return (samples * ramp).astype(np.int16).tobytes()
+
+    def _comfort_noise(self):
+        """Generates white noise at the sender's background level."""
+        noise = np.random.normal(0.0, self._comfort_level, len(self.silence) // 2)
+        return np.clip(noise, -32768, 32767).astype(np.int16).tobytes()
+
+
+def replay_jitter_trace(arrivals, chunk_samples=CALL_CHUNK, rate=RATE, **buffer_options):
+    """Plays a recorded (seq, arrival) trace through a JitterBuffer on a simulated clock.
+
+    Returns the buffer's stats plus the added playout delay of the chunks that
+    were played, measured against the fastest transit seen in the trace. An
+    empty trace plays nothing and returns zeroed stats.
+    """
+    arrivals = sorted(arrivals, key=lambda item: item[1])
+    buffer = JitterBuffer(chunk_samples, rate, **buffer_options)
+    chunk_duration = buffer.chunk_duration
+    pcm = bytes(chunk_samples * CHANNELS * 2)
+    delays = []
+    index = 0
+    clock, end = 0.0, -1.0
+    if arrivals:
+        base_transit = min(arrival - seq * chunk_duration for seq, arrival in arrivals)
+        clock = arrivals[0][1]
+        end = arrivals[-1][1] + buffer.max_depth * chunk_duration
+    while clock <= end:
+        while index < len(arrivals) and arrivals[index][1] <= clock:
+            buffer.push(arrivals[index][0], pcm, arrivals[index][1])
+            index += 1
+        played = buffer.stats["played"]
+        seq, _ = buffer.pop()
+        if buffer.stats["played"] > played:
+            delays.append(clock - (seq * chunk_duration + base_transit))
+        clock += chunk_duration
+    stats = dict(buffer.stats)
+    stats["mean_delay_ms"] = float(np.mean(delays)) * 1000 if delays else 0.0
+    stats["max_delay_ms"] = float(np.max(delays)) * 1000 if delays else 0.0
+    stats["final_jitter_ms"] = buffer.jitter * 1000
+    return stats
+
+
+def save_jitter_trace(path, arrivals):
+    """Writes a (seq, arrival) trace, such as Peer.audio_trace, as one "seq arrival" line per packet."""
+    with open(path, 'w') as f:
+        for seq, arrival in arrivals:
+            f.write(f"{seq} {arrival:.6f}\n")
+
+
+def load_jitter_trace(path):
+    """Reads a trace written by save_jitter_trace, ready for replay_jitter_trace."""
+    with open(path) as f:
+        return [(int(seq), float(arrival)) for seq, arrival in (line.split() for line in f if line.strip())]
+
+
+class CallRecorder:
+    """Writes the packets of a call to a seekable recording file on a background thread.
+
+    Packets are stored exactly as they were sent or received: JPEG keyframes,
+    tile deltas and numbered PCM chunks, each with a timestamp and track. add()
+    only timestamps the packet and queues it, so the call never waits for the
+    disk. Video is only accepted while the queue is less than
+    RECORDING_VIDEO_SHARE full. When the disk falls behind, the recording
+    continues with audio only and picks video up again at the next keyframe
+    once the writer has caught up. The recording also starts each track at a
+    keyframe. on_video_gap(track) is called when a track starts skipping
+    video, so the caller can ask for a keyframe instead of waiting for the
+    next periodic one. On close an index of keyframes and audio positions is
+    appended, which CallRecording uses to seek.
+    """
+
+    def __init__(self, path, queue_size=RECORDING_QUEUE_SIZE, on_video_gap=None):
+        self.path = path
+        self.started = time.monotonic()
+        self.video_limit = int(queue_size * RECORDING_VIDEO_SHARE)
+        self.on_video_gap = on_video_gap
+        self.stats = {"packets": 0, "video_dropped": 0, "audio_dropped": 0}
+        self.closed = False
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Tracks whose video resumes at the next keyframe; deltas from before the start cannot be decoded
+        self._video_waiting = {TRACK_LOCAL, TRACK_REMOTE}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "wb", buffering=RECORDING_BUFFER)
+        self._file.write(RECORDING_MAGIC)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def add(self, track, packet_type, payload):
+        """Queues a packet from the call path without blocking."""
+        if self.closed:
+            return
+        if packet_type in (PACKET_VIDEO, PACKET_VIDEO_DELTA):
+            if track in self._video_waiting:
+                if packet_type != PACKET_VIDEO or self._queue.qsize() >= self.video_limit // 2:
+                    self.stats["video_dropped"] += 1
+                    return
+                self._video_waiting.discard(track)
+            elif self._queue.qsize() >= self.video_limit:
+                # The disk is behind: keep the audio, skip video until the next keyframe
+                self._video_waiting.add(track)
+                self.stats["video_dropped"] += 1
+                if self.on_video_gap:
+                    self.on_video_gap(track)
+                return
+        try:
+            self._queue.put_nowait((time.monotonic() - self.started, track, packet_type, payload))
+        except queue.Full:
+            self.stats["audio_dropped"] += 1
+
+    def _write_loop(self):
+        index = []
+        last_audio_entry = {}
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                timestamp, track, packet_type, payload = item
+                offset = self._file.tell()
+                if packet_type == PACKET_VIDEO:
+                    index.append(INDEX_ENTRY.pack(timestamp, track, packet_type, offset))
+                elif packet_type in (PACKET_AUDIO, PACKET_COMFORT_NOISE):
+                    if timestamp - last_audio_entry.get(track, -RECORDING_INDEX_INTERVAL) >= RECORDING_INDEX_INTERVAL:
+                        index.append(INDEX_ENTRY.pack(timestamp, track, packet_type, offset))
+                        last_audio_entry[track] = timestamp
+                self._file.write(RECORD_HEADER.pack(timestamp, track, packet_type, len(payload)))
+                self._file.write(payload)
+                self.stats["packets"] += 1
+            index_offset = self._file.tell()
+            self._file.write(b"".join(index))
+            self._file.write(INDEX_TRAILER.pack(index_offset, INDEX_MAGIC))
+        except OSError as e:
+            print(f"[ERROR] Writing call recording {self.path} failed: {e}")
+            self.closed = True
+        finally:
+            self._file.close()
+
+    def close(self, wait=False):
+        """Stops accepting packets; the writer finishes the queued ones and appends the index."""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(None)
+        if wait:
+            self._writer.join()
+
+
+class CallRecording:
+    """Reads a file written by CallRecorder.
+
+    A recording whose index is missing, e.g. because the program stopped
+    during a call, is still readable; its index is rebuilt by scanning.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+                raise ValueError(f"{path} is not a call recording")
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            self.index = None
+            if size >= len(RECORDING_MAGIC) + INDEX_TRAILER.size:
+                f.seek(size - INDEX_TRAILER.size)
+                index_offset, magic = INDEX_TRAILER.unpack(f.read(INDEX_TRAILER.size))
+                if magic == INDEX_MAGIC:
+                    f.seek(index_offset)
+                    data = f.read(size - INDEX_TRAILER.size - index_offset)
+                    self.index = list(INDEX_ENTRY.iter_unpack(data))
+                    self.data_end = index_offset
+            if self.index is None:
+                self.data_end = size
+                self.index = [(timestamp, track, packet_type, offset)
+                              for offset, (timestamp, track, packet_type, _) in self._scan(len(RECORDING_MAGIC))
+                              if packet_type in (PACKET_VIDEO, PACKET_AUDIO, PACKET_COMFORT_NOISE)]
+        # The index skips most packets, so read on from its last entry to find the last one
+        last_offset = max((entry[3] for entry in self.index), default=len(RECORDING_MAGIC))
+        self.duration = max((packet[0] for _, packet in self._scan(last_offset)), default=0.0)
+
+    def _scan(self, offset):
+        """Yields (offset, (timestamp, track, packet type, payload)) from offset to the end of the packets."""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while offset + RECORD_HEADER.size <= self.data_end:
+                timestamp, track, packet_type, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                payload = f.read(length)
+                if len(payload) < length:
+                    break  # Cut off while it was being written
+                yield offset, (timestamp, track, packet_type, payload)
+                offset += RECORD_HEADER.size + length
+
+    def seek(self, position):
+        """Returns the file offset to read from so every track can be decoded from position seconds on."""
+        start = self.data_end
+        for track in {entry[1] for entry in self.index}:
+            entries = [entry for entry in self.index if entry[1] == track and entry[0] <= position]
+            keyframes = [entry for entry in entries if entry[2] == PACKET_VIDEO]
+            chosen = (keyframes or entries or [None])[-1]
+            start = min(start, chosen[3] if chosen else len(RECORDING_MAGIC))
+        return start if self.index else len(RECORDING_MAGIC)
+
+    def packets(self, position=0.0):
+        """Yields (timestamp, track, packet type, payload), starting early enough to decode position."""
+        for _, packet in self._scan(self.seek(position)):
+            yield packet
+
+    def frames(self, track=TRACK_REMOTE, position=0.0):
+        """Yields (timestamp, BGR picture) of a track's video from position seconds on."""
+        canvas = TileCanvas()
+        for timestamp, packet_track, packet_type, payload in self.packets(position):
+            if packet_track != track:
+                continue
+            if packet_type == PACKET_VIDEO:
+                frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if frame is None:
+                    continue
+                canvas.apply_keyframe(frame)
+            elif packet_type != PACKET_VIDEO_DELTA or not canvas.apply_delta(payload):
+                continue
+            if timestamp >= position:
+                yield timestamp, canvas.picture()
+
+    def export_audio(self, wav_path, track=TRACK_REMOTE):
+        """Writes a track's audio to a WAV file, with silence for suppressed and lost chunks."""
+        chunks = {}
+        for _, packet_track, packet_type, payload in self.packets():
+            if packet_track == track and packet_type == PACKET_AUDIO:
+                chunks[AUDIO_SEQ.unpack_from(payload)[0]] = payload[AUDIO_SEQ.size:]
+        silence = bytes(CALL_CHUNK * CHANNELS * 2)
+        with wave.open(wav_path, "wb") as wav:
+            wav.setnchannels(CHANNELS)
+            wav.setsampwidth(2)
+            wav.setframerate(RATE)
+            for seq in range(min(chunks, default=0), max(chunks, default=-1) + 1):
+                wav.writeframes(chunks.get(seq, silence))
+
+
+class LatestFrameSlot:
+    """Single-slot mailbox between pipeline stages that only ever holds the newest item."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        """Stores item, replacing one the consumer has not picked up yet."""
+        with self._cond:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Takes the newest item, waiting up to timeout; returns None if there is none or the slot is closed."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or self._item is not None, timeout)
+            item, self._item = self._item, None
+            return item
+
+    def clear(self):
+        """Discards any pending item."""
+        with self._cond:
+            self._item = None
+
+    def close(self):
+        """Wakes up the consumer and lets it drain the last item."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class MediaSendQueue:
+    """Outgoing media for one call: audio chunks stay in order, video keeps only the newest frame.
+
+    Tile deltas build on the keyframe before them, so a queued keyframe is
+    never replaced by a delta, and deltas are dropped while an earlier
+    keyframe is still being encoded (see expect_keyframe). Dropped deltas
+    are harmless because the next one carries their tiles. When a keyframe
+    has to be dropped, on_keyframe_dropped is called to get a new one.
+    """
+
+    def __init__(self, max_audio=AUDIO_QUEUE_SIZE, on_keyframe_dropped=None):
+        self._cond = threading.Condition()
+        self._audio = collections.deque(maxlen=max_audio)
+        self._video = None
+        self._last_video_seq = -1
+        self._keyframes_encoding = set()
+        self.on_keyframe_dropped = on_keyframe_dropped
+        self.frames_dropped = 0
+        self.closed = False
+
+    def put_audio(self, chunk, packet_type=PACKET_AUDIO):
+        """Queues an audio packet; the oldest one is discarded once the queue is full."""
+        with self._cond:
+            self._audio.append((packet_type, chunk))
+            self._cond.notify()
+
+    def expect_keyframe(self, seq):
+        """Notes that keyframe seq was handed to the encoders, so later deltas wait for it."""
+        with self._cond:
+            self._keyframes_encoding.add(seq)
+
+    def drop_keyframe(self, seq):
+        """Reports that keyframe seq was lost before reaching the queue."""
+        with self._cond:
+            self._keyframes_encoding.discard(seq)
+            self.frames_dropped += 1
+        if self.on_keyframe_dropped:
+            self.on_keyframe_dropped()
+
+    def put_video(self, seq, packet_type, frame_data):
+        """Offers an encoded frame, replacing any frame still waiting to be sent."""
+        keyframe = packet_type == PACKET_VIDEO
+        with self._cond:
+            self._keyframes_encoding.discard(seq)
+            queued_seq, queued_type = self._video[:2] if self._video else (self._last_video_seq, None)
+            if keyframe:
+                # A keyframe replaces a newer queued delta, since that delta may build on it
+                drop = seq <= self._last_video_seq or (queued_type == PACKET_VIDEO and seq <= queued_seq)
+            else:
+                # An encoder finished an older frame after a newer one, or the delta's keyframe is not out yet
+                drop = (seq <= queued_seq or queued_type == PACKET_VIDEO
+                        or any(pending < seq for pending in self._keyframes_encoding))
+            if not drop:
+                if self._video:
+                    self.frames_dropped += 1
+                self._video = (seq, packet_type, frame_data)
+                self._cond.notify()
+                return
+            self.frames_dropped += 1
+        if keyframe and self.on_keyframe_dropped:
+            self.on_keyframe_dropped()
+
+    def get(self, timeout=None):
+        """Returns the next (packet type, seq, payload) to send, audio first, or None."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or self._audio or self._video, timeout)
+            if self.closed:
+                return None
+            if self._audio:
+                packet_type, chunk = self._audio.popleft()
+                return packet_type, None, chunk
+            if self._video:
+                seq, packet_type, frame_data = self._video
+                self._video = None
+                self._last_video_seq = seq
+                return packet_type, seq, frame_data
+            return None
+
+    def close(self):
+        """Wakes up the sender and rejects further items."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class Outbox:
+    """Disk-backed queue of outgoing messages per peer, kept until the peer confirms delivery.
+
+    Every message is one file under <root>/<peer ip>/ whose name starts with a
+    sequence number, so directory order is send order. Expired messages and the
+    oldest ones beyond the per-peer count and size limits are deleted whenever
+    the queue is touched.
+    """
+
+    def __init__(self, root, max_messages=OUTBOX_MAX_MESSAGES, max_bytes=OUTBOX_MAX_BYTES, ttl=OUTBOX_TTL):
+        self.root = root
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._next_seq = {}
+        self._sent_at = collections.defaultdict(dict)  # Peer IP -> message id -> time last sent
+
+    def _peer_dir(self, ip):
+        return os.path.join(self.root, ip.replace(":", "_"))
+
+    def _entries(self, ip):
+        """Returns (path, message id, size, mtime) of the messages queued for ip, oldest first."""
+        try:
+            with os.scandir(self._peer_dir(ip)) as it:
+                found = sorted((entry.name, entry.path, entry.stat()) for entry in it if entry.name.endswith(".msg"))
+        except FileNotFoundError:
+            return []
+        return [(path, name[:-4].split("_", 1)[1], stat.st_size, stat.st_mtime) for name, path, stat in found]
+
+    def _prune(self, ip, entries):
+        """Deletes expired messages and the oldest ones over the limits; returns the entries left."""
+        now = time.time()
+        kept = [entry for entry in entries if now - entry[3] < self.ttl]
+        dropped = [entry for entry in entries if now - entry[3] >= self.ttl]
+        total = sum(entry[2] for entry in kept)
+        while kept and (len(kept) > self.max_messages or total > self.max_bytes):
+            entry = kept.pop(0)
+            total -= entry[2]
+            dropped.append(entry)
+        if dropped:
+            print(f"[INFO] Dropped {len(dropped)} undelivered messages for {ip}")
+        for path, message_id, _, _ in dropped:
+            self._delete(ip, path, message_id)
+        return kept
+
+    def _delete(self, ip, path, message_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._sent_at[ip].pop(message_id, None)
+
+    def add(self, ip, stream_id, body):
+        """Stores a message for ip and returns its id."""
+        message_id = uuid.uuid4().hex
+        with self._lock:
+            directory = self._peer_dir(ip)
+            os.makedirs(directory, exist_ok=True)
+            entries = self._entries(ip)
+            seq = self._next_seq.get(ip)
+            if seq is None:
+                seq = int(os.path.basename(entries[-1][0]).split("_", 1)[0]) + 1 if entries else 0
+            self._next_seq[ip] = seq + 1
+
+            path = os.path.join(directory, f"{seq:012d}_{message_id}.msg")
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump({"id": message_id, "stream": stream_id, "body": body}, f)
+            os.replace(path + ".tmp", path)
+            self._prune(ip, entries + [(path, message_id, os.path.getsize(path), time.time())])
+        return message_id
+
+    def has_pending(self, ip):
+        try:
+            return any(name.endswith(".msg") for name in os.listdir(self._peer_dir(ip)))
+        except FileNotFoundError:
+            return False
+
+    def due(self, ip, limit=OUTBOX_BATCH_SIZE):
+        """Returns up to limit (message id, stream id, body) for ip, oldest first, skipping ones sent recently."""
+        with self._lock:
+            now = time.monotonic()
+            sent_at = self._sent_at[ip]
+            batch = []
+            for path, message_id, _, _ in self._prune(ip, self._entries(ip)):
+                if now - sent_at.get(message_id, -OUTBOX_RETRY_INTERVAL) < OUTBOX_RETRY_INTERVAL:
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        message = pickle.load(f)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    continue
+                batch.append((message_id, message["stream"], message["body"]))
+                if len(batch) >= limit:
+                    break
+            return batch
+
+    def mark_sent(self, ip, message_id):
+        with self._lock:
+            self._sent_at[ip][message_id] = time.monotonic()
+
+    def reset_sent(self, ip):
+        """Makes every unconfirmed message for ip due again, e.g. after its session dropped."""
+        with self._lock:
+            self._sent_at[ip].clear()
+
+    def remove(self, ip, message_id):
+        """Deletes a message once the peer confirmed it."""
+        with self._lock:
+            for path, queued_id, _, _ in self._entries(ip):
+                if queued_id == message_id:
+                    self._delete(ip, path, message_id)
+                    break
+
+
+class ImageStore:
+    """Content-addressed store for image messages and their thumbnails.
+
+    Images are saved as <root>/<sha256> and thumbnails as
+    <root>/thumbs/<sha256>.jpg, so an image is only ever decoded at full size
+    once. Decoded thumbnails are also kept in an LRU cache in memory.
+    Thumbnails are made by worker threads and handed to a callback, so
+    callers on the UI thread never wait for a decode. Received chunks are
+    collected under <root>/partial/<sha256>/ until the image is complete.
+    The sender's outbox may drop some chunks of an image, so partial
+    directories that received nothing for partial_ttl are deleted.
+    """
+
+    def __init__(self, root, cache_size=THUMBNAIL_CACHE_SIZE, workers=THUMBNAIL_WORKERS, partial_ttl=OUTBOX_TTL):
+        self.root = root
+        self.cache_size = cache_size
+        self.partial_ttl = partial_ttl
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()  # Digest -> RGB thumbnail
+        self._pending = {}  # Digest -> callbacks waiting for its thumbnail
+        self._requests = queue.Queue()
+        os.makedirs(os.path.join(root, "thumbs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "partial"), exist_ok=True)
+        self.prune_partial()
+        for _ in range(workers):
+            threading.Thread(target=self._thumbnail_worker, daemon=True).start()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def add(self, data):
+        """Stores image bytes and returns their digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.has(digest):
+            self._write(digest, data)
+        return digest
+
+    def _write(self, digest, data):
+        path = self.path(digest)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def is_digest(digest):
+        """True if digest is a sha256 hex digest as this store names files, which makes it safe in a path."""
+        return isinstance(digest, str) and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+    def add_chunk(self, digest, index, count, data):
+        """Keeps one received chunk; returns True if it completed the image, which is then stored and verified."""
+        # Everything here comes from the remote peer, so check it before it reaches a path
+        if (not self.is_digest(digest) or type(index) is not int or type(count) is not int
+                or not 0 <= index < count <= IMAGE_MAX_CHUNKS or not isinstance(data, bytes)
+                or len(data) > IMAGE_CHUNK_SIZE):
+            print("[ERROR] Discarding an invalid image chunk")
+            return False
+        if self.has(digest):
+            # Already have this image, e.g. it was sent before; report it once per transfer
+            return index == count - 1
+        directory = os.path.join(self.root, "partial", digest)
+        if not os.path.isdir(directory):
+            # A new transfer is a good moment to clear out abandoned ones
+            self.prune_partial()
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"{index:06d}"), "wb") as f:
+                f.write(data)
+            paths = [os.path.join(directory, f"{number:06d}") for number in range(count)]
+            if not all(os.path.exists(path) for path in paths):
+                return False
+            parts = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    parts.append(f.read())
+            data = b"".join(parts)
+            for path in paths:
+                os.remove(path)
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # Chunks beyond count from a corrupt transfer are left for prune_partial
+            if hashlib.sha256(data).hexdigest() != digest:
+                print(f"[ERROR] Received image {digest[:12]} is corrupt, discarding it")
+                return False
+            self._write(digest, data)
+        return True
+
+    def prune_partial(self):
+        """Deletes the chunks of transfers that received nothing for partial_ttl."""
+        partial_root = os.path.join(self.root, "partial")
+        expired = time.time() - self.partial_ttl
+        with self._lock:
+            for digest in os.listdir(partial_root):
+                directory = os.path.join(partial_root, digest)
+                if not self.is_digest(digest) or not os.path.isdir(directory):
+                    continue
+                try:
+                    if os.path.getmtime(directory) >= expired:
+                        continue
+                    for name in os.listdir(directory):
+                        # Only the numbered chunk files add_chunk writes
+                        if len(name) == 6 and name.isdigit():
+                            os.remove(os.path.join(directory, name))
+                    os.rmdir(directory)
+                except OSError as e:
+                    print(f"[ERROR] Could not remove partial image {digest[:12]}: {e}")
+
+    def request_thumbnail(self, digest, callback):
+        """Calls callback(digest, thumbnail) with an RGB array, or None if the image cannot be read.
+
+        Cached thumbnails are returned right away; others are made on a worker thread.
+        """
+        with self._lock:
+            thumbnail = self._cache.get(digest)
+            if thumbnail is not None:
+                self._cache.move_to_end(digest)
+            elif digest in self._pending:
+                self._pending[digest].append(callback)
+                return
+            else:
+                self._pending[digest] = [callback]
+                self._requests.put(digest)
+                return
+        callback(digest, thumbnail)
+
+    def _thumbnail_worker(self):
+        while True:
+            digest = self._requests.get()
+            try:
+                thumbnail = self._load_thumbnail(digest)
+            except Exception as e:
+                print(f"[ERROR] Making thumbnail for {digest[:12]} failed: {e}")
+                thumbnail = None
+            with self._lock:
+                callbacks = self._pending.pop(digest, [])
+                if thumbnail is not None:
+                    self._cache[digest] = thumbnail
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+            for callback in callbacks:
+                callback(digest, thumbnail)
+
+    def _load_thumbnail(self, digest):
+        """Reads the thumbnail from disk, making it from the full image the first time."""
+        thumb_path = os.path.join(self.root, "thumbs", digest + ".jpg")
+        if os.path.exists(thumb_path):
+            thumbnail = cv2.imdecode(np.fromfile(thumb_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if thumbnail is not None:
+                return cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)
+        if not self.has(digest):
+            return None
+        data = np.fromfile(self.path(digest), dtype=np.uint8)
+        image = None
+        if len(data) > REDUCED_DECODE_BYTES:
+            # Let the decoder skip most of the work for photos; fall back if that is too small
+            image = cv2.imdecode(data, cv2.IMREAD_REDUCED_COLOR_4)
+            if image is not None and max(image.shape[:2]) < THUMBNAIL_SIZE:
+                image = None
+        if image is None:
+            image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if image is None:
+            return None
+        height, width = image.shape[:2]
+        scale = THUMBNAIL_SIZE / max(height, width)
+        if scale < 1:
+            image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        if ok:
+            with open(thumb_path + ".tmp", "wb") as f:
+                f.write(encoded.tobytes())
+            os.replace(thumb_path + ".tmp", thumb_path)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class TokenBucket:
+    """Paces outgoing bytes to rate per second, allowing bursts of up to burst bytes.
+
+    Each caller names how many tokens it must leave in the bucket, so
+    lower-priority traffic stops while some budget is still free for the
+    traffic above it.
+    """
+
+    def __init__(self, rate=EGRESS_BANDWIDTH, burst=EGRESS_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, size, reserve=0):
+        """Spends size tokens and returns 0, or returns the seconds to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            needed = min(size + reserve, self.burst)
+            if self._tokens < needed:
+                return (needed - self._tokens) / self.rate
+            self._tokens -= size
+            return 0.0
+
+
+class PeerSession:
+    """One long-lived TCP connection to a peer that carries every feature as a separate stream.
+
+    Messages are split into fragments of at most SESSION_FRAGMENT_SIZE and
+    each stream has its own bounded send queue. A writer thread sends the
+    streams fragment by fragment in STREAM_PRIORITIES order, round-robin
+    within a class, paced by the budget shared with the other sessions. A
+    large transfer therefore never holds up call audio or control messages
+    for more than one fragment. The writer sends keepalives while idle. A reader thread
+    reassembles messages and passes them to on_message(session, stream_id,
+    payload). The session closes itself when nothing, not even a keepalive,
+    has arrived for KEEPALIVE_TIMEOUT seconds.
+    """
+
+    def __init__(self, sock, remote_ip, dialed, on_message, on_close, budget=None):
+        self.sock = sock
+        self.remote_ip = remote_ip
+        self.dialed = dialed
+        self.on_message = on_message
+        self.on_close = on_close
+        self.budget = budget
+        self.alive = True
+        self._cond = threading.Condition()
+        self._fragments = collections.defaultdict(collections.deque)
+        self._queued_bytes = collections.Counter()
+        self._ready_streams = collections.deque()
+
+    def start(self):
+        self.sock.settimeout(KEEPALIVE_TIMEOUT)
+        if self.sock.family in (socket.AF_INET, socket.AF_INET6):
+            # Not applicable to the socketpair() the tests use
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def send(self, stream_id, payload, timeout=None):
+        """Queues a message on a stream, waiting while that stream's queue is full.
+
+        Returns False if the session closed or the wait timed out.
+        """
+        limit = STREAM_QUEUE_LIMITS.get(stream_id, SESSION_QUEUE_BYTES)
+        with self._cond:
+            # A message larger than the limit is still accepted once the stream has drained
+            has_room = lambda: (not self.alive or self._queued_bytes[stream_id] == 0
+                                or self._queued_bytes[stream_id] + len(payload) <= limit)
+            if not self._cond.wait_for(has_room, timeout) or not self.alive:
+                return False
+            fragments = self._fragments[stream_id]
+            if not fragments:
+                self._ready_streams.append(stream_id)
+            fragment_size = self._fragment_size()
+            for start in range(0, max(len(payload), 1), fragment_size):
+                chunk = payload[start:start + fragment_size]
+                flags = FLAG_MORE if start + fragment_size < len(payload) else 0
+                fragments.append(FRAME_HEADER.pack(stream_id, flags, len(chunk)) + chunk)
+            self._queued_bytes[stream_id] += len(payload)
+            self._cond.notify_all()
+        return True
+
+    def _fragment_size(self):
+        """Largest fragment that goes out within half the audio latency target at the paced rate."""
+        if self.budget is None:
+            return SESSION_FRAGMENT_SIZE
+        return max(1024, min(SESSION_FRAGMENT_SIZE, int(self.budget.rate * AUDIO_LATENCY_TARGET / 2)))
+
+    def _next_fragment(self):
+        """Takes the next fragment of the most urgent stream, or a keepalive after an idle interval."""
+        with self._cond:
+            while True:
+                self._cond.wait_for(lambda: not self.alive or self._ready_streams, KEEPALIVE_INTERVAL)
+                if not self.alive:
+                    return None
+                if not self._ready_streams:
+                    return FRAME_HEADER.pack(STREAM_KEEPALIVE, 0, 0)
+                # min() keeps the first of equal priorities, which gives round-robin within a class
+                stream_id = min(self._ready_streams, key=lambda stream: STREAM_PRIORITIES.get(stream, 4))
+                fragments = self._fragments[stream_id]
+                if self.budget is None:
+                    break
+                reserve = STREAM_PRIORITIES.get(stream_id, 4) * EGRESS_RESERVE_STEP
+                delay = self.budget.take(len(fragments[0]), reserve)
+                if not delay:
+                    break
+                # Wait for tokens, unless something more urgent is queued meanwhile
+                self._cond.wait(delay)
+            self._ready_streams.remove(stream_id)
+            fragment = fragments.popleft()
+            self._queued_bytes[stream_id] -= len(fragment) - FRAME_HEADER.size
+            if fragments:
+                self._ready_streams.append(stream_id)
+            self._cond.notify_all()
+            return fragment
+
+    def _write_loop(self):
+        try:
+            while self.alive:
+                fragment = self._next_fragment()
+                if fragment is None:
+                    break
+                self.sock.sendall(fragment)
+        except OSError as e:
+            if self.alive:
+                print(f"[ERROR] Session to {self.remote_ip} failed while sending: {e}")
+        finally:
+            self.close()
+
+    def _read_loop(self):
+        partial = {}
+        try:
+            while self.alive:
+                header = self._receive_exact(FRAME_HEADER.size)
+                if header is None:
+                    break
+                stream_id, flags, length = FRAME_HEADER.unpack(header)
+                data = self._receive_exact(length) if length else b""
+                if data is None:
+                    break
+                if stream_id == STREAM_KEEPALIVE:
+                    continue
+                if flags & FLAG_MORE:
+                    partial.setdefault(stream_id, []).append(data)
+                    continue
+                parts = partial.pop(stream_id, None)
+                if parts:
+                    parts.append(data)
+                    data = b"".join(parts)
+                try:
+                    self.on_message(self, stream_id, data)
+                except Exception as e:
+                    print(f"[ERROR] Handling session message from {self.remote_ip} failed: {e}")
+        except socket.timeout:
+            print(f"[INFO] Session to {self.remote_ip} timed out")
+        except OSError as e:
+            if self.alive:
+                print(f"[ERROR] Session to {self.remote_ip} failed while receiving: {e}")
+        finally:
+            self.close()
+
+    def _receive_exact(self, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        received = 0
+        while received < length:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                return None
+            received += count
+        return bytes(data)
+
+    def close(self):
+        """Closes the connection; queued messages are discarded."""
+        with self._cond:
+            if not self.alive:
+                return
+            self.alive = False
+            self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.on_close(self)
+
 
 class Peer:
-    def __init__(self, username=None):
+    """One messenger instance.
+
+    By default a peer listens on all interfaces at the standard ports and
+    announces itself by broadcast. bind_address, the ports and
+    broadcast_addresses let several peers share one host, e.g. on loopback
+    aliases as scale_simulator.py does; each needs its own data_dir.
+    with_audio=False skips opening the audio device for peers that only
+    exchange messages. egress_bandwidth is the rate in bytes per second that
+    all sessions together are paced to; set it a little below the link rate,
+    or to None to send unpaced.
+    """
+
+    def __init__(self, username=None, bind_address="", broadcast_port=BROADCAST_PORT, session_port=SESSION_PORT,
+                 broadcast_addresses=BROADCAST_ADDRESSES, broadcast_interval=BROADCAST_INTERVAL,
+                 data_dir=DATA_DIR, with_audio=True, egress_bandwidth=EGRESS_BANDWIDTH):
+        self.bind_address = bind_address
+        self.broadcast_port = broadcast_port
+        self.session_port = session_port
+        self.broadcast_addresses = broadcast_addresses
+        self.broadcast_interval = broadcast_interval
+        # Announcements from these addresses are our own
+        self.own_address = bind_address or socket.gethostbyname(socket.gethostname())
         self.active_windows = set()
         self.message_queues = {}
         self.username = username if username else socket.gethostname()
@@ -33,41 +1449,57 @@ class Peer:
         self.video_call_callback = None
         self.voice_message_callback = None
         self.text_message_callback = None
+        self.image_message_callback = None
         self.call_end_callback = None
-        self.current_voice_conn = None
+        self.current_voice_data = None
         self.current_voice_addr = None
         self.video_call_active = False
-        self.current_video_conn = None
-        self.video_send_socket = None
-        self.video_recv_socket = None
         self.current_call_peer = None
+        self.received_video = None
+        self.received_audio = None
+        self.audio_trace = None  # Set to a list to record call audio arrivals
+        self.remote_frames = LatestFrameSlot()
+        self.video_display_size = (FRAME_WIDTH, FRAME_HEIGHT)
+        self.video_stats = {"decode_ms": 0.0, "frames_decoded": 0, "frames_skipped": 0}
+        self.audio_stats = {"chunks_sent": 0, "chunks_suppressed": 0}
+        self.video_delta_mode = VIDEO_DELTA_MODE
+        self.video_encoder = None
+        self.video_source_factory = CameraSource
+        self.sessions = {}  # Peer IP -> session used for sending
+        self.all_sessions = set()  # Includes duplicates left over from simultaneous connects
+        self.sessions_lock = threading.Lock()
+        self.connect_locks = collections.defaultdict(threading.Lock)
+        # Shared by all sessions
+        self.egress_budget = TokenBucket(egress_bandwidth, EGRESS_BURST) if egress_bandwidth else None
+        self.data_dir = data_dir
+        self.call_recorder = None
+        self.outbox = Outbox(os.path.join(data_dir, "outbox"))
+        self.images = ImageStore(os.path.join(data_dir, "images"))
+        self.flushing = set()  # Peer IPs whose outbox is being sent
+        self.flush_requests = set()  # Peer IPs whose outbox should be checked again
+        self.delivered_messages = collections.OrderedDict()  # (peer IP, message id) of recent messages
 
         # Initialize all sockets
         self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.broadcast_socket.bind(("", BROADCAST_PORT))
-
-        self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.video_socket.bind(("", VIDEO_PORT))
-        self.video_socket.listen(5)
+        self.broadcast_socket.bind((bind_address, broadcast_port))
 
-        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.control_socket.bind(("", CONTROL_PORT))
+        self.session_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.session_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.session_socket.bind((bind_address, session_port))
+        self.session_socket.listen(128)
 
-        self.text_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.text_socket.bind(("", TEXT_PORT))
-
-        self.voice_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.voice_socket.bind(("", VOICE_PORT))
-        self.voice_socket.listen(1)
-
-        self.audio = pyaudio.PyAudio()
+        self.audio = pyaudio.PyAudio() if with_audio else None
 
     def set_call_end_callback(self, callback):
         """Sets callback for handling call end events."""
         self.call_end_callback = callback
 
     # Callback setters
+    def set_video_source(self, factory):
+        """Sets the callable that opens the video source for the next call, e.g. CameraSource or ScreenSource."""
+        self.video_source_factory = factory
+
     def set_video_call_callback(self, callback):
         """Sets callback for handling video call requests."""
         self.video_call_callback = callback
@@ -80,16 +1512,22 @@ class Peer:
         """Set callback function for incoming text messages."""
         self.text_message_callback = callback
 
+    def set_image_message_callback(self, callback):
+        """Set callback function for incoming images, called with (digest, name, addr)."""
+        self.image_message_callback = callback
+
     # Peer Discovery Methods
     def broadcast_presence(self):
         """Broadcasts presence to network."""
+        message = pickle.dumps({"username": self.username})
         while self.running:
-            try:
-                message = pickle.dumps({"username": self.username})
-                self.broadcast_socket.sendto(message, ("255.255.255.255", BROADCAST_PORT))
-            except Exception as e:
-                print(f"[ERROR] Broadcast failed: {e}")
-            threading.Event().wait(5)
+            for address in self.broadcast_addresses:
+                try:
+                    self.broadcast_socket.sendto(message, (address, self.broadcast_port))
+                except Exception as e:
+                    if self.running:
+                        print(f"[ERROR] Broadcast failed: {e}")
+            threading.Event().wait(self.broadcast_interval)
 
     def listen_for_peers(self):
         """Listens for other peers on the network."""
@@ -97,28 +1535,201 @@ class Peer:
             try:
                 data, addr = self.broadcast_socket.recvfrom(BUFFER_SIZE)
                 peer_info = pickle.loads(data)
-                if addr[0] != socket.gethostbyname(socket.gethostname()):
+                if addr[0] != self.own_address:
                     self.peers.add((peer_info["username"], addr[0]))
+                    # The peer is reachable again, deliver anything waiting for it
+                    if self.outbox.has_pending(addr[0]):
+                        self.schedule_outbox_flush(addr[0])
             except Exception as e:
-                print(f"[ERROR] Peer discovery failed: {e}")
-
-    # Control Communication Methods
-    def send_control_message(self, message, addr):
-        """Sends control message to specified address."""
-        try:
-            self.control_socket.sendto(pickle.dumps(message), addr)
-        except Exception as e:
-            print(f"[ERROR] Failed to send control message: {e}")
+                if self.running:
+                    print(f"[ERROR] Peer discovery failed: {e}")
 
-    def listen_for_control_messages(self):
-        """Listens for control messages."""
+    # Session Methods
+    def listen_for_sessions(self):
+        """Accepts session connections from other peers."""
         while self.running:
             try:
-                data, addr = self.control_socket.recvfrom(BUFFER_SIZE)
-                message = pickle.loads(data)
-                self.handle_control_message(message, addr)
+                conn, addr = self.session_socket.accept()
+                self._register_session(conn, addr[0], dialed=False)
             except Exception as e:
-                print(f"[ERROR] Control message handling failed: {e}")
+                if self.running:
+                    print(f"[ERROR] Session listener failed: {e}")
+
+    def get_session(self, ip):
+        """Returns the live session to ip, connecting first if there is none."""
+        with self.sessions_lock:
+            connect_lock = self.connect_locks[ip]
+        with connect_lock:
+            session = self.sessions.get(ip)
+            if session and session.alive:
+                return session
+            # Connect from our own address, the other side identifies peers by IP
+            source = (self.bind_address, 0) if self.bind_address else None
+            conn = socket.create_connection((ip, self.session_port), timeout=CONNECT_TIMEOUT,
+                                            source_address=source)
+            return self._register_session(conn, ip, dialed=True)
+
+    def _register_session(self, conn, ip, dialed):
+        session = PeerSession(conn, ip, dialed, self.handle_session_message, self._session_closed,
+                              budget=self.egress_budget)
+        with self.sessions_lock:
+            self.all_sessions.add(session)
+            current = self.sessions.get(ip)
+            # Both peers may connect at the same time. Each keeps sending on the session it
+            # started with and receives on both, so nothing queued on either one is lost.
+            if not (current and current.alive):
+                self.sessions[ip] = session
+        session.start()
+        if self.outbox.has_pending(ip):
+            self.schedule_outbox_flush(ip)
+        return session
+
+    def _session_closed(self, session):
+        ip = session.remote_ip
+        with self.sessions_lock:
+            self.all_sessions.discard(session)
+            if self.sessions.get(ip) is session:
+                del self.sessions[ip]
+                replacement = next((other for other in self.all_sessions
+                                    if other.remote_ip == ip and other.alive), None)
+                if replacement:
+                    self.sessions[ip] = replacement
+        # Whatever was in flight on this session may not have arrived
+        self.outbox.reset_sent(ip)
+        if not self.running or ip in self.sessions:
+            return
+        if session.dialed:
+            threading.Thread(target=self._reconnect, args=(ip,), daemon=True).start()
+        elif self.video_call_active and ip == self.current_call_peer:
+            threading.Thread(target=self._await_reconnect, args=(ip,), daemon=True).start()
+
+    def _reconnect(self, ip):
+        """Re-establishes a session that dropped, backing off between attempts."""
+        for delay in RECONNECT_DELAYS:
+            time.sleep(delay)
+            if not self.running:
+                return
+            try:
+                self.get_session(ip)
+                print(f"[INFO] Reconnected session to {ip}")
+                return
+            except OSError:
+                continue
+        print(f"[INFO] Could not reconnect session to {ip}")
+        if self.video_call_active and ip == self.current_call_peer:
+            self._handle_call_end(ip)
+
+    def _await_reconnect(self, ip):
+        """Keeps a call to ip up for RECONNECT_GRACE while the side that dialed reconnects."""
+        deadline = time.monotonic() + RECONNECT_GRACE
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            if not self.running or self._live_session(ip):
+                return
+        print(f"[INFO] {ip} did not reconnect")
+        if self.video_call_active and ip == self.current_call_peer:
+            self._handle_call_end(ip)
+
+    def _live_session(self, ip):
+        """Returns the current session to ip if it is up, without connecting."""
+        with self.sessions_lock:
+            session = self.sessions.get(ip)
+        return session if session and session.alive else None
+
+    def send_to_peer(self, ip, stream_id, payload, timeout=None):
+        """Sends payload on a stream of the session to ip; returns False if it could not be queued."""
+        try:
+            return self.get_session(ip).send(stream_id, payload, timeout)
+        except OSError as e:
+            print(f"[ERROR] Could not connect to {ip}: {e}")
+            return False
+
+    def handle_session_message(self, session, stream_id, payload):
+        """Dispatches a message received on a session to the handler for its stream."""
+        addr = (session.remote_ip, self.session_port)
+        if stream_id in (STREAM_MEDIA, STREAM_CALL_AUDIO):
+            self.handle_media_packet(payload, addr)
+        elif stream_id == STREAM_CONTROL:
+            self.handle_control_message(pickle.loads(payload), addr)
+        elif stream_id in (STREAM_TEXT, STREAM_VOICE, STREAM_FILE):
+            self.handle_queued_message(stream_id, pickle.loads(payload), addr)
+
+    # Outbox Methods
+    def queue_message(self, ip, stream_id, body):
+        """Stores a message in the outbox for ip and starts delivering it in the background."""
+        message_id = self.outbox.add(ip, stream_id, body)
+        self.schedule_outbox_flush(ip)
+        return message_id
+
+    def schedule_outbox_flush(self, ip):
+        threading.Thread(target=self.flush_outbox, args=(ip,), daemon=True).start()
+
+    def flush_outbox(self, ip):
+        """Sends queued messages for ip; entries stay on disk until their receipt arrives.
+
+        Only one flush runs per peer. Requests made while it runs make it go
+        over the outbox once more instead of starting another thread.
+        """
+        with self.sessions_lock:
+            self.flush_requests.add(ip)
+            if ip in self.flushing:
+                return
+            self.flushing.add(ip)
+        try:
+            while True:
+                with self.sessions_lock:
+                    if not self.running or ip not in self.flush_requests:
+                        self.flushing.discard(ip)
+                        return
+                    self.flush_requests.discard(ip)
+                self._send_due_messages(ip)
+        except OSError as e:
+            print(f"[INFO] {ip} is unreachable, keeping its messages queued: {e}")
+            with self.sessions_lock:
+                self.flushing.discard(ip)
+                self.flush_requests.discard(ip)
+
+    def _send_due_messages(self, ip):
+        """Sends the due outbox entries for ip in batches of OUTBOX_BATCH_SIZE."""
+        while self.running:
+            batch = self.outbox.due(ip)
+            if not batch:
+                return
+            session = self.get_session(ip)
+            for message_id, stream_id, body in batch:
+                if not session.send(stream_id, pickle.dumps({"id": message_id, "body": body})):
+                    # The session dropped; its messages become due again once it is back
+                    return
+                self.outbox.mark_sent(ip, message_id)
+
+    def handle_queued_message(self, stream_id, envelope, addr):
+        """Delivers a message sent from another peer's outbox and confirms it with a receipt."""
+        key = (addr[0], envelope["id"])
+        if key not in self.delivered_messages:
+            if stream_id == STREAM_TEXT:
+                self.handle_text_message(envelope["body"].decode(), addr)
+            elif stream_id == STREAM_FILE:
+                self.handle_image_chunk(pickle.loads(envelope["body"]), addr)
+            else:
+                self.handle_voice_message(envelope["body"], addr)
+            self.delivered_messages[key] = True
+            if len(self.delivered_messages) > DELIVERED_HISTORY:
+                self.delivered_messages.popitem(last=False)
+        self.send_control_message({"type": "receipt", "id": envelope["id"]}, addr)
+
+    # Control Communication Methods
+    def send_control_message(self, message, addr):
+        """Sends control message to specified address without blocking the caller, which may be the UI."""
+        payload = pickle.dumps(message)
+        session = self._live_session(addr[0])
+        if session and session.send(STREAM_CONTROL, payload, timeout=0):
+            return
+        # Connecting can take up to CONNECT_TIMEOUT, so do it on a worker
+        threading.Thread(target=self._send_control_payload, args=(payload, addr[0]), daemon=True).start()
+
+    def _send_control_payload(self, payload, ip):
+        if not self.send_to_peer(ip, STREAM_CONTROL, payload):
+            print(f"[ERROR] Failed to send control message to {ip}")
 
     def handle_control_message(self, message, addr):
         """Handles received control messages."""
@@ -126,39 +1737,45 @@ class Peer:
             if message.get("type") == "call_request":
                 print(f"Incoming call request from {addr[0]}")
                 if self.video_call_callback:
-                    self.video_call_callback(addr[0])
+                    # The callback may wait for the user, which must not stall this session's reader
+                    threading.Thread(target=self.video_call_callback, args=(addr[0],), daemon=True).start()
             elif message.get("type") == "call_accept":
                 threading.Thread(target=self.establish_video_call, args=(addr[0],), daemon=True).start()
+            elif message.get("type") == "receipt":
+                self.outbox.remove(addr[0], message["id"])
+            elif message.get("type") == "keyframe_request":
+                if self.video_encoder:
+                    self.video_encoder.request_keyframe()
             elif message.get("type") == "call_decline":
                 print(f"Call request to {addr[0]} was declined")
             elif message.get("type") == "call_end":
                 print(f"Call ended by {addr[0]}")
-                self.video_call_active = False
-                cv2.destroyAllWindows()
-                # Notify frontend about call end
-                if self.call_end_callback:
-                    self.call_end_callback(addr[0])
-                # Close any active video connections
-                if hasattr(self, 'video_socket'):
-                    try:
-                        self.video_socket.close()
-                    except:
-                        pass
+                self._handle_call_end(addr[0])
         except Exception as e:
             print(f"[ERROR] Failed to handle control message: {e}")
 
+    def _handle_call_end(self, ip):
+        """Tears down the call after the other side ended it or became unreachable."""
+        self.video_call_active = False
+        self.stop_receiving_video()
+        self.current_call_peer = None
+        self.remote_frames.clear()
+        # Notify frontend about call end
+        if self.call_end_callback:
+            self.call_end_callback(ip)
+
     # Video Call Methods
     def start_video_call(self, recipient_ip):
         """Initiates a video call with specified IP."""
         try:
-            self.send_control_message({"type": "call_request"}, (recipient_ip, CONTROL_PORT))
+            self.send_control_message({"type": "call_request"}, (recipient_ip, SESSION_PORT))
         except Exception as e:
             print(f"[ERROR] Could not start video call: {e}")
 
     def accept_video_call(self, caller_ip):
         """Accepts an incoming video call."""
         try:
-            self.send_control_message({"type": "call_accept"}, (caller_ip, CONTROL_PORT))
+            self.send_control_message({"type": "call_accept"}, (caller_ip, SESSION_PORT))
             threading.Thread(target=self.establish_video_call, args=(caller_ip,), daemon=True).start()
         except Exception as e:
             print(f"[ERROR] Could not accept video call: {e}")
@@ -166,131 +1783,334 @@ class Peer:
     def reject_video_call(self, caller_ip):
         """Rejects an incoming video call."""
         try:
-            self.send_control_message({"type": "call_decline"}, (caller_ip, CONTROL_PORT))
+            self.send_control_message({"type": "call_decline"}, (caller_ip, SESSION_PORT))
         except Exception as e:
             print(f"[ERROR] Could not reject video call: {e}")
 
     def end_video_call(self):
-        """Ends the current video call and cleans up resources."""
+        """Ends the current video call, tells the other side and cleans up resources."""
         try:
+            call_peer = self.current_call_peer
             self.video_call_active = False
+            self.stop_receiving_video()
 
-            # Close video connections
-            if self.video_send_socket:
-                try:
-                    self.video_send_socket.close()
-                except:
-                    pass
-                self.video_send_socket = None
-
-            if self.video_recv_socket:
-                try:
-                    self.video_recv_socket.close()
-                except:
-                    pass
-                self.video_recv_socket = None
-
-            # Close any active video windows
-            cv2.destroyAllWindows()
-
-            # Reset current call peer
+            # Reset current call peer and drop the last remote frame
             self.current_call_peer = None
+            self.remote_frames.clear()
 
+            if call_peer:
+                self.send_control_message({"type": "call_end"}, (call_peer, SESSION_PORT))
         except Exception as e:
             print(f"[ERROR] Error ending video call: {e}")
 
     def establish_video_call(self, recipient_ip):
-        """Establishes video call connection."""
+        """Starts sending and receiving call media over the session to recipient_ip."""
         try:
             self.video_call_active = True
-            send_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            send_socket.connect((recipient_ip, VIDEO_PORT))
-            threading.Thread(target=self.send_video_stream, args=(send_socket,), daemon=True).start()
-
-            recv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            recv_socket.bind(("", VIDEO_PORT + 1))
-            recv_socket.listen(1)
-            conn, addr = recv_socket.accept()
-            threading.Thread(target=self.receive_video_stream, args=(conn,), daemon=True).start()
+            self.current_call_peer = recipient_ip
+            self.start_receiving_video()
+            threading.Thread(target=self.send_video_stream, args=(recipient_ip,), daemon=True).start()
         except Exception as e:
             print(f"[ERROR] Could not establish video call: {e}")
             self.video_call_active = False
 
-    def listen_for_video_calls(self):
-        """Listens for incoming video calls."""
-        while self.running:
-            try:
-                conn, addr = self.video_socket.accept()
-                if self.video_call_active:
-                    threading.Thread(target=self.receive_video_stream, args=(conn,), daemon=True).start()
-            except Exception as e:
-                print(f"[ERROR] Video call listener failed: {e}")
-
-    def send_video_stream(self, conn):
-        """Sends video stream to connected peer."""
-        cap = cv2.VideoCapture(0)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
-
-        stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
+    def send_video_stream(self, recipient_ip):
+        """Sends video stream to connected peer.
 
+        Capture, encoding and sending run as separate stages connected by
+        bounded queues, so a slow network only ever delays the newest frame.
+        In delta mode only the tiles that changed are encoded and sent, with
+        periodic full keyframes. Frames come from video_source_factory.
+        While the session is down, media is dropped until the session is back,
+        which then starts with a keyframe, or until the call is ended.
+        """
         try:
-            while self.running and self.video_call_active and cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    break
-
-                _, jpeg_frame = cv2.imencode('.jpg', frame)
-                video_data = pickle.dumps(jpeg_frame)
-
-                conn.sendall(struct.pack('>I', len(video_data)))
-                conn.sendall(video_data)
+            session = self.get_session(recipient_ip)
+            source = self.video_source_factory()
+        except Exception as e:
+            print(f"[ERROR] Could not start video stream: {e}")
+            return
 
-                audio_data = stream.read(CHUNK)
-                conn.sendall(struct.pack('>I', len(audio_data)))
-                conn.sendall(audio_data)
+        stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True,
+                                 frames_per_buffer=CALL_CHUNK)
+
+        captured = queue.Queue(maxsize=CAPTURE_QUEUE_SIZE)
+        encoder = None
+        if self.video_delta_mode:
+            encoder = TileDeltaEncoder(threshold=source.tile_threshold, keyframe_interval=source.keyframe_interval)
+        self.video_encoder = encoder
+        outgoing = MediaSendQueue(on_keyframe_dropped=encoder.request_keyframe if encoder else None)
+        workers = [threading.Thread(target=self._capture_video_frames, args=(source, captured, outgoing, encoder),
+                                    daemon=True),
+                   threading.Thread(target=self._capture_audio_chunks, args=(stream, outgoing), daemon=True)]
+        workers += [threading.Thread(target=self._encode_video_frames, args=(source, captured, outgoing), daemon=True)
+                    for _ in range(ENCODE_WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        disconnected = False
+        try:
+            while self.running and self.video_call_active and not outgoing.closed:
+                item = outgoing.get(timeout=0.1)
+                if item is None:
+                    continue
+                packet_type, seq, payload = item
+                if not session.alive:
+                    # Pick up the session that replaced it; _reconnect or _await_reconnect ends the call otherwise
+                    session = self._live_session(recipient_ip) or session
+                    if not session.alive:
+                        disconnected = True
+                        continue
+                if disconnected:
+                    disconnected = False
+                    if encoder:
+                        encoder.request_keyframe()
+                    self.request_keyframe()
+                if seq is None:
+                    # Audio and comfort-noise packets
+                    if not session.send(STREAM_CALL_AUDIO, bytes([packet_type]) + payload):
+                        continue
+                    recorder = self.call_recorder
+                    if recorder:
+                        recorder.add(TRACK_LOCAL, packet_type, payload)
+                    continue
+                if not session.send(STREAM_MEDIA, bytes([packet_type]) + payload, timeout=MEDIA_SEND_WAIT):
+                    if not session.alive:
+                        continue
+                    # Not acknowledged, so the encoder resends this frame's tiles with the next one
+                    if encoder and packet_type == PACKET_VIDEO:
+                        encoder.request_keyframe()
+                    continue
+                if encoder:
+                    encoder.acknowledge(seq)
+                recorder = self.call_recorder
+                if recorder:
+                    recorder.add(TRACK_LOCAL, packet_type, payload)
         except Exception as e:
             print(f"[ERROR] Video stream sending failed: {e}")
         finally:
-            cap.release()
+            outgoing.close()
+            self.video_encoder = None
+            for worker in workers:
+                worker.join(timeout=1)
+            if outgoing.frames_dropped:
+                print(f"[INFO] Dropped {outgoing.frames_dropped} stale video frames")
+            source.release()
             stream.stop_stream()
             stream.close()
-            conn.close()
-
-    def receive_video_stream(self, conn):
-        """Receives and displays video stream from connected peer."""
-        stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
-
+            if self.running and self.video_call_active and self.current_call_peer == recipient_ip:
+                # Capture or sending failed while the call was still up
+                self._handle_call_end(recipient_ip)
+                self.send_control_message({"type": "call_end"}, (recipient_ip, SESSION_PORT))
+
+    def _capture_video_frames(self, source, captured, outgoing, encoder):
+        """Reads source frames into the encode queue, keeping only the most recent ones.
+
+        Tile differencing needs frames in capture order, so it happens here
+        rather than in the encoder pool.
+        """
+        seq = 0
         try:
-            while self.running and self.video_call_active:
-                data = conn.recv(4)
-                if not data:
+            while self.running and self.video_call_active and not outgoing.closed:
+                frame = source.read()
+                if frame is None:
                     break
-                video_length = struct.unpack('>I', data)[0]
-                video_data = self.receive_all(conn, video_length)
+                prepared = encoder.prepare(seq, frame) if encoder else (PACKET_VIDEO, frame)
+                if prepared is not None:
+                    if encoder and prepared[0] == PACKET_VIDEO:
+                        outgoing.expect_keyframe(seq)
+                    for old_seq, packet_type, _ in put_latest(captured, (seq,) + prepared):
+                        if encoder and packet_type == PACKET_VIDEO:
+                            outgoing.drop_keyframe(old_seq)
+                seq += 1
+        except Exception as e:
+            print(f"[ERROR] Video capture failed: {e}")
+        finally:
+            outgoing.close()
 
-                if video_data:
-                    frame = pickle.loads(video_data)
-                    frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+    def _encode_video_frames(self, source, captured, outgoing):
+        """Encodes captured frames in the source's format; several run in parallel since cv2 releases the GIL."""
+        while not outgoing.closed:
+            try:
+                seq, packet_type, data = captured.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if packet_type == PACKET_VIDEO_DELTA:
+                header, image = data
+            else:
+                header, image = b"", data
+            ok, encoded = cv2.imencode(source.image_format, image, source.encode_params)
+            if ok:
+                outgoing.put_video(seq, packet_type, header + encoded.tobytes())
+            elif packet_type == PACKET_VIDEO:
+                outgoing.drop_keyframe(seq)
+
+    def _capture_audio_chunks(self, stream, outgoing):
+        """Reads microphone chunks into the send queue, numbering them for the receiver's jitter buffer.
+
+        Silent chunks are not sent. Instead, a comfort-noise marker with the
+        background level goes out when silence starts and every
+        COMFORT_NOISE_INTERVAL chunks after that.
+        """
+        detector = VoiceActivityDetector(VAD_CALL_HANGOVER)
+        seq = 0
+        silent_run = 0
+        try:
+            while self.running and self.video_call_active and not outgoing.closed:
+                pcm = stream.read(CALL_CHUNK, exception_on_overflow=False)
+                if detector.is_speech(pcm):
+                    outgoing.put_audio(AUDIO_SEQ.pack(seq) + pcm)
+                    self.audio_stats["chunks_sent"] += 1
+                    silent_run = 0
+                else:
+                    if silent_run % COMFORT_NOISE_INTERVAL == 0:
+                        level = min(int(detector.noise_floor), 0xFFFF)
+                        outgoing.put_audio(AUDIO_SEQ.pack(seq) + COMFORT_NOISE.pack(level), PACKET_COMFORT_NOISE)
+                    self.audio_stats["chunks_suppressed"] += 1
+                    silent_run += 1
+                seq += 1
+        except Exception as e:
+            print(f"[ERROR] Audio capture failed: {e}")
+        finally:
+            outgoing.close()
+
+    def start_receiving_video(self):
+        """Starts the workers that handle incoming call media.
+
+        The session reader only queues received packets. Frames are decoded on a
+        worker that catches up on everything queued and publishes only the
+        newest picture, and audio is played from a jitter buffer on its own
+        thread, so neither decoding nor playback holds up socket reads. Decoded
+        frames are published in remote_frames for the UI to render.
+        """
+        self.stop_receiving_video()
+        encoded_frames = VideoPacketQueue()
+        jitter_buffer = JitterBuffer(trace=self.audio_trace)
+        threading.Thread(target=self._decode_video_frames, args=(encoded_frames,), daemon=True).start()
+        threading.Thread(target=self._play_call_audio, args=(jitter_buffer, encoded_frames), daemon=True).start()
+        self.received_audio = jitter_buffer
+        self.received_video = encoded_frames
+
+    def stop_receiving_video(self):
+        """Stops the media workers of the current call, if any, and its recording."""
+        self.stop_call_recording()
+        encoded_frames, self.received_video = self.received_video, None
+        if encoded_frames:
+            encoded_frames.close()
+            self.video_stats["frames_skipped"] += encoded_frames.dropped
+
+    def start_call_recording(self, path=None):
+        """Records both sides of the current call; returns the recording's path, or None without a call."""
+        if self.received_video is None or not self.current_call_peer:
+            print("[ERROR] There is no call to record.")
+            return None
+        if self.call_recorder:
+            return self.call_recorder.path
+        if path is None:
+            name = f"call_{self.current_call_peer.replace(':', '_')}_{time.strftime('%Y%m%d_%H%M%S')}.p2prec"
+            path = os.path.join(self.data_dir, "recordings", name)
+        try:
+            self.call_recorder = CallRecorder(path, on_video_gap=self._request_recording_keyframe)
+        except OSError as e:
+            print(f"[ERROR] Could not start call recording: {e}")
+            return None
+        # The recording starts each side's video at a keyframe, so ask for them now
+        self._request_recording_keyframe(TRACK_LOCAL)
+        self._request_recording_keyframe(TRACK_REMOTE)
+        print(f"[INFO] Recording call to {path}")
+        return path
+
+    def _request_recording_keyframe(self, track):
+        """Gets a keyframe on track so the recording can continue its video."""
+        if track == TRACK_LOCAL:
+            encoder = self.video_encoder
+            if encoder:
+                encoder.request_keyframe()
+        else:
+            self.request_keyframe()
+
+    def stop_call_recording(self):
+        recorder, self.call_recorder = self.call_recorder, None
+        if recorder:
+            recorder.close()
+            stats = recorder.stats
+            if stats["video_dropped"] or stats["audio_dropped"]:
+                print(f"[INFO] Disk was behind during recording: skipped {stats['video_dropped']} video and "
+                      f"{stats['audio_dropped']} audio packets")
+            print(f"[INFO] Call recording saved to {recorder.path}")
+
+    def handle_media_packet(self, payload, addr):
+        """Queues a packet received on STREAM_MEDIA or STREAM_CALL_AUDIO for the call's media workers."""
+        encoded_frames = self.received_video
+        if encoded_frames is None or addr[0] != self.current_call_peer:
+            return
+        packet_type, data = payload[0], payload[1:]
+        recorder = self.call_recorder
+        if recorder:
+            recorder.add(TRACK_REMOTE, packet_type, data)
+        if packet_type in (PACKET_VIDEO, PACKET_VIDEO_DELTA):
+            encoded_frames.put(packet_type, data)
+        elif packet_type == PACKET_AUDIO:
+            seq = AUDIO_SEQ.unpack_from(data)[0]
+            self.received_audio.push(seq, data[AUDIO_SEQ.size:], time.monotonic())
+        elif packet_type == PACKET_COMFORT_NOISE:
+            seq, level = AUDIO_SEQ.unpack_from(data)[0], COMFORT_NOISE.unpack_from(data, AUDIO_SEQ.size)[0]
+            self.received_audio.push_comfort_noise(seq, level, time.monotonic())
+
+    def _decode_video_frames(self, encoded_frames):
+        """Applies received keyframes and tile deltas, then scales the newest picture for display."""
+        canvas = TileCanvas()
+        while not encoded_frames.closed:
+            packets, overflowed = encoded_frames.get_all(timeout=0.1)
+            if overflowed:
+                canvas = TileCanvas()
+                self.request_keyframe()
+            if not packets:
+                continue
+            started = time.perf_counter()
+            for packet_type, payload in packets:
+                if packet_type == PACKET_VIDEO:
+                    frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
                     if frame is not None:
-                        cv2.imshow('Remote Video', frame)
-
-                data = conn.recv(4)
-                if not data:
-                    break
-                audio_length = struct.unpack('>I', data)[0]
-                audio_data = self.receive_all(conn, audio_length)
-
-                if audio_data:
-                    stream.write(audio_data)
-
-                if cv2.waitKey(1) & 0xFF == ord('q'):
+                        canvas.apply_keyframe(frame)
+                elif not canvas.apply_delta(payload):
+                    canvas = TileCanvas()
+                    self.request_keyframe()
                     break
+            if canvas.frame is None:
+                continue
+            frame = self._fit_frame_for_display(canvas.picture())
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stats = self.video_stats
+            stats["decode_ms"] += (elapsed_ms - stats["decode_ms"]) * DECODE_TIME_SMOOTHING
+            stats["frames_decoded"] += 1
+            self.remote_frames.put(frame)
+
+    def request_keyframe(self):
+        """Asks the peer on the other end of the call for a full frame."""
+        if self.current_call_peer:
+            self.send_control_message({"type": "keyframe_request"}, (self.current_call_peer, SESSION_PORT))
+
+    def _fit_frame_for_display(self, frame):
+        """Scales a BGR frame into video_display_size and converts it to RGB."""
+        max_width, max_height = self.video_display_size
+        height, width = frame.shape[:2]
+        scale = min(max_width / width, max_height / height)
+        if scale < 1:
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    def _play_call_audio(self, jitter_buffer, encoded_frames):
+        """Plays the jitter buffer until the call's media workers stop; the blocking write paces playout."""
+        stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True,
+                                 frames_per_buffer=CALL_CHUNK)
+        try:
+            while not encoded_frames.closed:
+                _, pcm = jitter_buffer.pop()
+                stream.write(pcm)
         except Exception as e:
-            print(f"[ERROR] Video stream receiving failed: {e}")
+            print(f"[ERROR] Call audio playback failed: {e}")
         finally:
-            conn.close()
-            cv2.destroyAllWindows()
             stream.stop_stream()
             stream.close()
 
@@ -312,6 +2132,10 @@ class Peer:
         stream.stop_stream()
         stream.close()
 
+        recorded = len(self.audio_frames)
+        self.audio_frames = trim_silence(self.audio_frames)
+        print(f"[INFO] Recorded {len(self.audio_frames)} chunks, trimmed {recorded - len(self.audio_frames)} silent ones.")
+
     def stop_recording(self):
         """Stops voice recording."""
         self.is_recording = False
@@ -323,68 +2147,55 @@ class Peer:
             return
 
         try:
-            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            conn.settimeout(10)
-            conn.connect((recipient_ip, VOICE_PORT))
-
-            for frame in self.audio_frames:
-                conn.sendall(frame)
-            conn.close()
-            print("[INFO] Voice recording sent successfully.")
+            self.queue_message(recipient_ip, STREAM_VOICE, b"".join(self.audio_frames))
+            print("[INFO] Voice recording queued for delivery.")
         except Exception as e:
             print(f"[ERROR] Failed to send voice recording: {e}")
 
-    def listen_for_voice_messages(self):
-        """Listens for incoming voice messages."""
-        while self.running:
-            try:
-                conn, addr = self.voice_socket.accept()
-                print(f"[INFO] Receiving voice message from {addr[0]}...")
+    def handle_voice_message(self, audio_data, addr):
+        """Handles a voice message received on STREAM_VOICE."""
+        print(f"[INFO] Received voice message from {addr[0]}")
 
-                self.current_voice_conn = conn
-                self.current_voice_addr = addr
-
-                if self.voice_message_callback:
-                    self.voice_message_callback(addr[0])
-                else:
-                    self.play_voice_message(conn)
-            except Exception as e:
-                print(f"[ERROR] Voice message reception failed: {e}")
+        # Asking the user and playing back both take a while, so keep them off the session reader
+        if self.voice_message_callback:
+            self.current_voice_data = audio_data
+            self.current_voice_addr = addr
+            threading.Thread(target=self.voice_message_callback, args=(addr[0],), daemon=True).start()
+        else:
+            threading.Thread(target=self.play_voice_message, args=(audio_data,), daemon=True).start()
 
-    def play_voice_message(self, conn):
+    def play_voice_message(self, audio_data):
         """Plays received voice message."""
         stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
         try:
-            while self.running:
-                data = conn.recv(CHUNK)
-                if not data:
+            chunk_bytes = CHUNK * CHANNELS * 2
+            for start in range(0, len(audio_data), chunk_bytes):
+                if not self.running:
                     break
-                stream.write(data)
+                stream.write(audio_data[start:start + chunk_bytes])
         finally:
             stream.stop_stream()
             stream.close()
-            conn.close()
 
     def accept_voice_message(self):
         """Accepts and plays current voice message."""
-        if hasattr(self, 'current_voice_conn'):
-            self.play_voice_message(self.current_voice_conn)
-            delattr(self, 'current_voice_conn')
-            delattr(self, 'current_voice_addr')
+        if self.current_voice_data is not None:
+            audio_data = self.current_voice_data
+            self.current_voice_data = None
+            self.current_voice_addr = None
+            self.play_voice_message(audio_data)
 
     def reject_voice_message(self):
         """Rejects current voice message."""
-        if hasattr(self, 'current_voice_conn'):
-            self.current_voice_conn.close()
-            delattr(self, 'current_voice_conn')
-            delattr(self, 'current_voice_addr')
+        self.current_voice_data = None
+        self.current_voice_addr = None
 
     # Text Message Methods
     def send_text_message(self, message, addr):
         """Sends text message to specified address."""
         try:
             message_with_sender = f"{self.username}: {message}"
-            self.text_socket.sendto(message_with_sender.encode(), addr)
+            self.queue_message(addr[0], STREAM_TEXT, message_with_sender.encode())
 
             # Save message to history
             self.save_file(self.username, message)
@@ -395,38 +2206,79 @@ class Peer:
         except Exception as e:
             print(f"[ERROR] Text message sending failed: {e}")
 
-    def listen_for_text_messages(self):
-        """Listens for incoming text messages."""
-        while self.running:
-            try:
-                data, addr = self.text_socket.recvfrom(BUFFER_SIZE)
-                message = data.decode()
+    def handle_text_message(self, message, addr):
+        """Handles a text message received on STREAM_TEXT."""
+        try:
+            # If sender's window is open, deliver immediately
+            if addr[0] in self.active_windows:
+                if self.text_message_callback:
+                    self.text_message_callback(message, addr)
+            else:
+                # Store message for later delivery
+                self.store_message(addr[0], message)
 
-                # If sender's window is open, deliver immediately
-                if addr[0] in self.active_windows:
-                    if self.text_message_callback:
-                        self.text_message_callback(message, addr)
-                else:
-                    # Store message for later delivery
-                    self.store_message(addr[0], message)
+            # Always save to file
+            self.save_file(addr[0], message)
+        except Exception as e:
+            print(f"[ERROR] Text message handling failed: {e}")
 
-                # Always save to file
-                self.save_file(addr[0], message)
-            except Exception as e:
-                print(f"[ERROR] Text message reception failed: {e}")
+    # Image Message Methods
+    def send_image(self, path, recipient_ip):
+        """Queues an image file for ip in IMAGE_CHUNK_SIZE chunks; returns its digest, or None on failure."""
+        try:
+            if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+                print(f"[ERROR] {path} is not a supported image")
+                return None
+            with open(path, "rb") as f:
+                data = f.read(IMAGE_MAX_BYTES + 1)
+            if len(data) > IMAGE_MAX_BYTES:
+                print(f"[ERROR] {path} is larger than {IMAGE_MAX_BYTES // (1024 * 1024)} MiB")
+                return None
+            digest = self.images.add(data)
+            name = os.path.basename(path)
+            count = max(1, -(-len(data) // IMAGE_CHUNK_SIZE))
+            for index in range(count):
+                chunk = {"image": digest, "name": name, "index": index, "count": count,
+                         "data": data[index * IMAGE_CHUNK_SIZE:(index + 1) * IMAGE_CHUNK_SIZE]}
+                self.outbox.add(recipient_ip, STREAM_FILE, pickle.dumps(chunk))
+            # One flush delivers all the chunks
+            self.schedule_outbox_flush(recipient_ip)
+            self.save_file(self.username, f"[image {name}]")
+            print(f"[INFO] Image {name} queued for delivery in {count} chunks.")
+            return digest
+        except Exception as e:
+            print(f"[ERROR] Failed to send image: {e}")
+            return None
 
-    def handle_text_message(self, message_data, addr):
-        """Handles incoming text messages."""
+    def handle_image_chunk(self, chunk, addr):
+        """Stores a chunk received on STREAM_FILE and announces the image once it is complete."""
         try:
-            if message_data["type"] == "text_message":
-                sender_username = message_data["username"]
-                message = message_data["message"]
-                print(f"[{sender_username}]: {message}")
-                if self.text_message_callback:
-                    self.text_message_callback(sender_username, message)
-                self.save_file(sender_username, message)
+            if not self.images.add_chunk(chunk["image"], chunk["index"], chunk["count"], chunk["data"]):
+                return
+            print(f"[INFO] Received image {chunk['name']} from {addr[0]}")
+            if addr[0] in self.active_windows and self.image_message_callback:
+                self.image_message_callback(chunk["image"], chunk["name"], addr)
+            else:
+                self.store_message(addr[0], {"image": chunk["image"], "name": chunk["name"]})
+            self.save_file(addr[0], f"[image {chunk['name']}]")
         except Exception as e:
-            print(f"[ERROR] Text message handling failed: {e}")
+            print(f"[ERROR] Image message handling failed: {e}")
+
+    # Unread Message Methods
+    def store_message(self, ip, message):
+        """Keeps a message until the chat window for ip is opened; images are stored as {"image", "name"}."""
+        self.message_queues.setdefault(ip, []).append(message)
+
+    def get_unread_messages(self, ip):
+        """Returns and clears the messages stored for ip."""
+        return self.message_queues.pop(ip, [])
+
+    def add_active_window(self, ip):
+        """Marks the chat window for ip as open, so its messages are delivered directly."""
+        self.active_windows.add(ip)
+
+    def remove_active_window(self, ip):
+        self.active_windows.discard(ip)
 
     def save_file(self, sender, message):
         """Saves all text messages between sender and receiver in a Chat.txt file on the PC desktop."""
@@ -439,32 +2291,22 @@ class Peer:
             print(f"[ERROR] Saving chat to file failed: {e}")
 
     # Utility Methods
-    def receive_all(self, conn, length):
-        """Receives all data of specified length from connection."""
-        data = b""
-        while len(data) < length:
-            packet = conn.recv(min(BUFFER_SIZE, length - len(data)))
-            if not packet:
-                return None
-            data += packet
-        return data
-
     def stop(self):
         """Stops all peer activities and closes connections."""
         self.running = False
         try:
-            # Close all sockets
+            # Close all sockets and sessions
             self.broadcast_socket.close()
-            self.video_socket.close()
-            self.control_socket.close()
-            self.text_socket.close()
-            self.voice_socket.close()
+            self.session_socket.close()
+            with self.sessions_lock:
+                sessions = list(self.all_sessions)
+            for session in sessions:
+                session.close()
+            self.stop_receiving_video()
 
             # Clean up audio
-            self.audio.terminate()
-
-            # Close any OpenCV windows
-            cv2.destroyAllWindows()
+            if self.audio:
+                self.audio.terminate()
 
             print("[INFO] Peer stopped successfully")
         except Exception as e:
@@ -474,10 +2316,7 @@ if __name__ == "__main__":
     peer = Peer()
     threading.Thread(target=peer.broadcast_presence, daemon=True).start()
     threading.Thread(target=peer.listen_for_peers, daemon=True).start()
-    threading.Thread(target=peer.listen_for_video_calls, daemon=True).start()
-    threading.Thread(target=peer.listen_for_control_messages, daemon=True).start()
-    threading.Thread(target=peer.listen_for_text_messages, daemon=True).start()
-    threading.Thread(target=peer.listen_for_voice_messages, daemon=True).start()
+    threading.Thread(target=peer.listen_for_sessions, daemon=True).start()
 
     def video_call_request_handler(ip):
         print(f"Incoming video call from {ip}. Accept? (yes/no)")
@@ -526,7 +2365,7 @@ if __name__ == "__main__":
         elif choice == "3":
             recipient_ip = input("Enter recipient IP: ")
             message = input("Enter your message: ")
-            peer.send_text_message(message, (recipient_ip, TEXT_PORT))
+            peer.send_text_message(message, (recipient_ip, SESSION_PORT))
         elif choice == "4":
             peer.start_recording()
         elif choice == "5":
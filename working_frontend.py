@@ -1,16 +1,21 @@
-import cv2
 import socket
 import threading
 import pickle
 import struct
+import time
+import queue
 import tkinter as tk
-from tkinter import messagebox
+from tkinter import messagebox, filedialog
 from ttkthemes import ThemedTk
 import ttkbootstrap as ttkb
-from working_backend import Peer
+from PIL import Image, ImageTk
+from working_backend import Peer, CameraSource, ScreenSource, SESSION_PORT, IMAGE_EXTENSIONS, mss
 import os
 from datetime import datetime
 
+VIDEO_DISPLAY_SIZE = (480, 360)
+RENDER_INTERVAL_MS = 15
+
 
 class PeerFrontend:
     def __init__(self, peer):
@@ -72,7 +77,10 @@ class PeerFrontend:
         # Get any stored messages for this peer
         stored_messages = self.peer.get_unread_messages(peer_ip)
         for message in stored_messages:
-            window.display_message(message)
+            if isinstance(message, dict):
+                window.display_image(message["image"], f"{peer_name} sent {message['name']}")
+            else:
+                window.display_message(message)
 
     def run(self):
         self.root.mainloop()
@@ -88,11 +96,19 @@ class PeerWindow:
         self.record_thread = None
         self.video_call_active = False
         self.last_saved_position = 1.0
+        self.video_buffers = [None, None]  # Two images, so the one on screen is never repainted
+        self.video_buffer_index = 0
+        self.rendered_frames = 0
+        self.render_started = time.monotonic()
+        self.thumbnail_images = []  # Keeps the inline images alive while they are shown
+        self.ready_thumbnails = queue.Queue()  # (text mark, RGB thumbnail) made by the image store's workers
+        self.received_images = queue.Queue()  # (digest, caption) from worker threads, shown by the UI thread
+        self.image_count = 0
 
         # Peer Window
         self.window = ttkb.Toplevel()
         self.window.title(f"Chat with {peer_name}")
-        self.window.geometry("800x600")
+        self.window.geometry("800x950")
         self.window.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # Peer Details
@@ -136,19 +152,44 @@ class PeerWindow:
         self.send_text_button = ttkb.Button(self.text_frame, text="Send Message", command=self.send_text_message)
         self.send_text_button.pack(side="right", padx=5, pady=5)
 
+        self.send_image_button = ttkb.Button(self.text_frame, text="Send Image", command=self.send_image)
+        self.send_image_button.pack(side="right", padx=5, pady=5)
+
         # Video Call
         self.video_frame = ttkb.Labelframe(self.window, text="Video Call")
         self.video_frame.pack(fill="both", padx=10, pady=10)
 
-        self.call_button = ttkb.Button(self.video_frame, text="Start Video Call", command=self.start_video_call)
+        self.video_controls = ttkb.Frame(self.video_frame)
+        self.video_controls.pack(fill="x")
+
+        self.call_button = ttkb.Button(self.video_controls, text="Start Video Call", command=self.start_video_call)
         self.call_button.pack(side="left", padx=5, pady=5)
 
-        self.end_call_button = ttkb.Button(self.video_frame, text="End Call", command=self.end_video_call,
+        self.end_call_button = ttkb.Button(self.video_controls, text="End Call", command=self.end_video_call,
                                            state='disabled')
         self.end_call_button.pack(side="left", padx=5, pady=5)
 
+        self.share_screen = tk.BooleanVar(value=False)
+        self.share_screen_check = ttkb.Checkbutton(self.video_controls, text="Share Screen",
+                                                   variable=self.share_screen, command=self.toggle_screen_share)
+        self.share_screen_check.pack(side="left", padx=5, pady=5)
+
+        self.record_call = tk.BooleanVar(value=False)
+        self.record_call_check = ttkb.Checkbutton(self.video_controls, text="Record Call",
+                                                  variable=self.record_call, command=self.toggle_call_recording)
+        self.record_call_check.pack(side="left", padx=5, pady=5)
+
+        self.video_stats_label = ttkb.Label(self.video_controls, text="")
+        self.video_stats_label.pack(side="right", padx=5, pady=5)
+
+        self.video_display = ttkb.Label(self.video_frame)
+        self.video_display.pack(padx=5, pady=5)
+        self.peer.video_display_size = VIDEO_DISPLAY_SIZE
+        self.window.after(RENDER_INTERVAL_MS, self.render_video_frame)
+
         # Attach callbacks
         self.peer.set_text_message_callback(self.handle_text_message)
+        self.peer.set_image_message_callback(self.handle_image_message)
         self.peer.set_video_call_callback(self.handle_video_call_request)
         self.peer.set_voice_message_callback(self.handle_voice_message)
 
@@ -259,10 +300,35 @@ class PeerWindow:
         if not message:
             messagebox.showwarning("Enter Message", "Please enter a message.")
             return
-        self.peer.send_text_message(message, (self.peer_ip, 5007))
+        self.peer.send_text_message(message, (self.peer_ip, SESSION_PORT))
         self.display_message(f"You: {message}")
         self.message_entry.delete(0, "end")
 
+    def send_image(self):
+        path = filedialog.askopenfilename(parent=self.window, title="Send Image",
+                                          filetypes=[("Images", " ".join("*" + ext for ext in IMAGE_EXTENSIONS))])
+        if not path:
+            return
+        # Reading, hashing and queueing a large image takes a while, so keep it off the UI thread
+        threading.Thread(target=self._send_image_file, args=(path,), daemon=True).start()
+
+    def _send_image_file(self, path):
+        digest = self.peer.send_image(path, self.peer_ip)
+        name = os.path.basename(path)
+        if digest is None:
+            self.received_images.put((None, f"Could not send {name}."))
+        else:
+            self.received_images.put((digest, f"You sent {name}"))
+
+    def handle_image_message(self, digest, name, addr):
+        """Handle incoming images."""
+        window = self.frontend.chat_windows.get(addr[0])
+        if window:
+            # This runs on the session reader thread; Tk widgets may only be touched from the UI thread
+            window.received_images.put((digest, f"{window.peer_name} sent {name}"))
+        else:
+            self.peer.store_message(addr[0], {"image": digest, "name": name})
+
     def start_video_call(self):
         if self.video_call_active:
             messagebox.showwarning("Call in Progress", "You are already in a video call.")
@@ -271,6 +337,34 @@ class PeerWindow:
         self.peer.start_video_call(self.peer_ip)
         self.display_message(f"Calling {self.peer_ip}...")
 
+    def toggle_screen_share(self):
+        """Chooses between camera and screen for the next call."""
+        if self.share_screen.get():
+            if mss is None:
+                messagebox.showwarning("Screen Sharing",
+                                       "Screen sharing requires the mss package (pip install mss).",
+                                       parent=self.window)
+                self.share_screen.set(False)
+                return
+            self.peer.set_video_source(ScreenSource)
+            self.display_message("Your screen will be shared in the next call")
+        else:
+            self.peer.set_video_source(CameraSource)
+            self.display_message("Your camera will be used in the next call")
+
+    def toggle_call_recording(self):
+        """Starts or stops recording the current call."""
+        if self.record_call.get():
+            path = self.peer.start_call_recording()
+            if path is None:
+                self.record_call.set(False)
+                messagebox.showwarning("Record Call", "Recording is only possible during a call.")
+                return
+            self.display_message(f"Recording call to {path}")
+        else:
+            self.peer.stop_call_recording()
+            self.display_message("Call recording stopped")
+
     def handle_video_call_request(self, caller_ip):
         def on_dialog_response():
             dialog.destroy()
@@ -325,13 +419,55 @@ class PeerWindow:
         self.call_button.config(state='normal')
         self.end_call_button.config(state='disabled')
 
-        cv2.destroyAllWindows()
-
-        if hasattr(self.peer, 'video_call_active'):
-            self.peer.video_call_active = False
+        self.peer.end_video_call()
 
+        self.clear_video_display()
         self.display_message("Video call ended")
 
+    def render_video_frame(self):
+        """Shows the newest remote frame, received images and finished thumbnails, polled from the Tk event loop."""
+        if not self.window.winfo_exists():
+            return
+        while not self.received_images.empty():
+            digest, caption = self.received_images.get()
+            if digest is None:
+                messagebox.showerror("Image Error", caption, parent=self.window)
+            else:
+                self.display_image(digest, caption)
+        while not self.ready_thumbnails.empty():
+            self.show_thumbnail(*self.ready_thumbnails.get())
+        if self.peer.current_call_peer == self.peer_ip:
+            frame = self.peer.remote_frames.get(timeout=0)
+            if frame is not None:
+                self.show_video_frame(Image.fromarray(frame))
+        self.window.after(RENDER_INTERVAL_MS, self.render_video_frame)
+
+    def show_video_frame(self, image):
+        """Paints image into the back buffer and then swaps it onto the screen."""
+        back_buffer = self.video_buffers[self.video_buffer_index]
+        if back_buffer is None or (back_buffer.width(), back_buffer.height()) != image.size:
+            back_buffer = ImageTk.PhotoImage(image)
+            self.video_buffers[self.video_buffer_index] = back_buffer
+        else:
+            back_buffer.paste(image)
+        self.video_display.configure(image=back_buffer)
+        self.video_buffer_index ^= 1
+
+        self.rendered_frames += 1
+        elapsed = time.monotonic() - self.render_started
+        if elapsed >= 1:
+            fps = self.rendered_frames / elapsed
+            decode_ms = self.peer.video_stats["decode_ms"]
+            self.video_stats_label.config(text=f"{fps:.0f} fps | decode {decode_ms:.1f} ms")
+            self.rendered_frames = 0
+            self.render_started = time.monotonic()
+
+    def clear_video_display(self):
+        self.record_call.set(False)
+        self.video_display.configure(image="")
+        self.video_buffers = [None, None]
+        self.video_stats_label.config(text="")
+
     def save_history(self):
         desktop_path = os.path.join(os.path.expanduser("~"), "Desktop")
         chat_file_path = os.path.join(desktop_path, f"Chat_{self.peer_name}_{self.peer_ip}.txt")
@@ -364,6 +500,31 @@ class PeerWindow:
                 # If window exists, display message
                 self.frontend.chat_windows[addr[0]].display_message(message)
 
+    def display_image(self, digest, caption):
+        """Adds a caption line with a place for the thumbnail, which is filled in once it is ready."""
+        if not self.message_display.winfo_exists():
+            return
+        self.display_message(caption)
+        mark = f"image{self.image_count}"
+        self.image_count += 1
+        self.message_display.mark_set(mark, "end-1c")
+        self.message_display.mark_gravity(mark, "left")
+        self.message_display.config(state='normal')
+        self.message_display.insert(tk.END, "\n")
+        self.message_display.config(state='disabled')
+        self.peer.images.request_thumbnail(digest, lambda _, thumbnail: self.ready_thumbnails.put((mark, thumbnail)))
+
+    def show_thumbnail(self, mark, thumbnail):
+        self.message_display.config(state='normal')
+        if thumbnail is None:
+            self.message_display.insert(mark, "[image could not be shown]")
+        else:
+            image = ImageTk.PhotoImage(Image.fromarray(thumbnail))
+            self.thumbnail_images.append(image)
+            self.message_display.image_create(mark, image=image, padx=5, pady=5)
+        self.message_display.config(state='disabled')
+        self.message_display.see(tk.END)
+
     def display_message(self, message):
         if not self.message_display.winfo_exists():
             return
@@ -379,9 +540,6 @@ if __name__ == "__main__":
 
     threading.Thread(target=peer.broadcast_presence, daemon=True).start()
     threading.Thread(target=peer.listen_for_peers, daemon=True).start()
-    threading.Thread(target=peer.listen_for_video_calls, daemon=True).start()
-    threading.Thread(target=peer.listen_for_control_messages, daemon=True).start()
-    threading.Thread(target=peer.listen_for_text_messages, daemon=True).start()
-    threading.Thread(target=peer.listen_for_voice_messages, daemon=True).start()
+    threading.Thread(target=peer.listen_for_sessions, daemon=True).start()
 
     frontend.run()
\ No newline at end of file